@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+"""
+Ultra Mario 2D Bros - headless benchmarks
+Run the parity checks and all benchmarks, or name one: python benchmarks.py broadphase
+Parity checks alone: python benchmarks.py check
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+from claudemario4k import (CHUNK_WIDTH, MOVE_SPEED, SCREEN_HEIGHT, SCREEN_WIDTH, SKY_BLUE,
+                           Game, GameState, Inputs, Level, LevelChunk, LevelFile, Mario,
+                           MarioBatch, Platform, PlatformGrid, ProceduralLevel,
+                           ProjectilePool, Rasterizer, ReplayReader, ReplayWriter,
+                           RewindBuffer, Simulation, VecMarioEnv, generated_level,
+                           level_file_name, play_replay, write_level_file)
+from export_levels import export
+
+def scripted_inputs(tick):
+    # Run right, back left, jumping every half second
+    pressed = [pygame.K_SPACE] if tick % 30 == 0 else []
+    right = (tick // 120) % 2 == 0
+    return Inputs(pressed, left=not right, right=right)
+
+def padded_level(count, tile_collision=False):
+    # World 1-1 plus extra platforms laid out to the right of the screen, as
+    # they would be in a longer level
+    sim = Simulation(tile_collision)
+    sim.start_level(1, 1)
+    level = sim.current_level
+    for i in range(count - len(level.platforms)):
+        x = SCREEN_WIDTH + (i // 4) * 120
+        y = 150 + (i % 4) * 90
+        level.platforms.append(Platform(x, y, 96, 20))
+    level.geometry_changed()
+    return sim
+
+class StairsSource:
+    # Level source for streaming: every chunk a stretch of ground with four
+    # bricks, two enemies and two coins
+    def __init__(self, screens):
+        self.width = screens * CHUNK_WIDTH
+        self.goal_x = self.width - 100
+        self.goal_y = 400
+
+    def chunk(self, index):
+        x = index * CHUNK_WIDTH
+        return LevelChunk([Platform(x, 500, CHUNK_WIDTH, 100)] +
+                          [Platform(x + 100 + i * 170, 420 - (index * 40 + i * 50) % 200, 100, 20,
+                                    type="brick") for i in range(4)],
+                          [(x + 300, 450, "goomba"), (x + 600, 450, "koopa")],
+                          [(x + 150, 300), (x + 490, 280)])
+
+class SparseSource(StairsSource):
+    # StairsSource with an empty first chunk and no ground in the second, so
+    # the platforms loaded at the start don't reach the view
+    def chunk(self, index):
+        if index == 0:
+            return LevelChunk()
+        chunk = super().chunk(index)
+        if index == 1:
+            return LevelChunk(chunk.platforms[1:], chunk.enemies, chunk.coins)
+        return chunk
+
+def ticks_per_second(sim, ticks):
+    start = time.perf_counter()
+    for tick in range(ticks):
+        sim.step(scripted_inputs(tick))
+    return ticks / (time.perf_counter() - start)
+
+def bench_broadphase(counts=(5, 50, 500, 1000, 5000, 10000), ticks=600):
+    print("platforms   full scan t/s   grid t/s   tiles t/s")
+    for count in counts:
+        sim = padded_level(count)
+        # One cell holding every platform is a full scan
+        sim.current_level.collision = PlatformGrid(sim.current_level.platforms, 10 ** 9)
+        scan = ticks_per_second(sim, ticks)
+        grid = ticks_per_second(padded_level(count), ticks)
+        tiles = ticks_per_second(padded_level(count, True), ticks)
+        print(f"{count:9d}   {scan:13.0f}   {grid:8.0f}   {tiles:9.0f}")
+
+def bench_batch(counts=(1, 100, 1000, 10000), ticks=300):
+    print("players   scalar player-ticks/s   batch player-ticks/s")
+    platforms = Level(1, 1).platforms
+    for count in counts:
+        marios = [Mario(100, 400) for _ in range(min(count, 1000))]
+        start = time.perf_counter()
+        for tick in range(ticks):
+            for mario in marios:
+                mario.move_right() if (tick // 120) % 2 == 0 else mario.move_left()
+                if tick % 30 == 0:
+                    mario.jump()
+                mario.update(platforms)
+        scalar = len(marios) * ticks / (time.perf_counter() - start)
+
+        batch = MarioBatch(count, platforms)
+        start = time.perf_counter()
+        for tick in range(ticks):
+            right = (tick // 120) % 2 == 0
+            batch.step([not right] * count, [right] * count, [tick % 30 == 0] * count)
+        vectorized = count * ticks / (time.perf_counter() - start)
+        print(f"{count:7d}   {scalar:21.0f}   {vectorized:20.0f}")
+
+def bench_entities(counts=(5, 100, 1000, 10000, 50000), ticks=300):
+    print("enemies   level ticks/s   ms/tick")
+    for count in counts:
+        sim = Simulation()
+        sim.start_level(1, 1)
+        level = sim.current_level
+        for i in range(count - len(level.enemies)):
+            level.enemies.add(40 + (i * 7) % 720, 100 + (i * 13) % 300,
+                              "goomba" if i % 2 == 0 else "koopa")
+        rate = ticks_per_second(sim, ticks)
+        print(f"{count:7d}   {rate:13.0f}   {1000 / rate:7.3f}")
+
+def bench_projectiles(capacities=(256, 2048, 16384), ticks=600):
+    # Bullet-hell pattern: a ring of shots from the arena centre every tick
+    print("capacity   live at end   ticks/s")
+    for capacity in capacities:
+        pool = ProjectilePool(capacity)
+        ring = max(1, capacity // 200)
+        angles = np.linspace(0, 2 * np.pi, ring, endpoint=False)
+        centre_x, centre_y = np.full(ring, 400.0), np.full(ring, 300.0)
+        start = time.perf_counter()
+        for tick in range(ticks):
+            turn = angles + tick * 0.05
+            pool.spawn_many(centre_x, centre_y, np.cos(turn) * 2, np.sin(turn) * 2)
+            pool.update()
+            pool.kill(pool.hits(150, 450, 20))
+        rate = ticks / (time.perf_counter() - start)
+        print(f"{capacity:8d}   {len(pool):11d}   {rate:7.0f}")
+
+def bench_static_layer(counts=(5, 100, 400), frames=200):
+    # Brick rows filling the screen, drawn per platform or from the cache
+    print("platforms   per-platform ms/frame   cached ms/frame")
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    for count in counts:
+        level = Level(1, 1)
+        del level.platforms[1:]
+        for i in range(count):
+            level.platforms.append(Platform((i % 8) * 100, 40 + (i // 8) * 9 % 440, 96, 32,
+                                            type="brick"))
+        level.geometry_changed()
+        start = time.perf_counter()
+        for frame in range(frames):
+            level.draw_static(screen)
+        direct = (time.perf_counter() - start) * 1000 / frames
+        start = time.perf_counter()
+        for frame in range(frames):
+            level.static_layer.draw(screen, level.draw_static)
+        cached = (time.perf_counter() - start) * 1000 / frames
+        print(f"{count:9d}   {direct:21.3f}   {cached:15.3f}")
+
+def bench_sprites(counts=(100, 1000, 5000), frames=100):
+    # On-screen enemies drawn with pygame.draw primitives per enemy (three
+    # ellipses per goomba, as before the sprite cache) vs cached-sprite blits
+    print("enemies   primitives ms/frame   sprites ms/frame")
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    for count in counts:
+        level = Level(1, 1)
+        for i in range(count):
+            level.enemies.add((i * 7) % 770, 40 + (i * 13) % 440)
+        positions = list(zip(level.enemies.x[:count].tolist(), level.enemies.y[:count].tolist()))
+        start = time.perf_counter()
+        for frame in range(frames):
+            for x, y in positions:
+                pygame.draw.ellipse(screen, (139, 90, 43), (x, y + 8, 32, 24))
+                pygame.draw.ellipse(screen, (0, 0, 0), (x + 4, y + 24, 10, 8))
+                pygame.draw.ellipse(screen, (0, 0, 0), (x + 18, y + 24, 10, 8))
+        primitives = (time.perf_counter() - start) * 1000 / frames
+        start = time.perf_counter()
+        for frame in range(frames):
+            level.enemies.draw(screen)
+        sprites = (time.perf_counter() - start) * 1000 / frames
+        print(f"{count:7d}   {primitives:19.3f}   {sprites:16.3f}")
+
+def bench_dirty_rects(frames=300):
+    # Presenting World 1-1 in play, full flips vs dirty-rect updates
+    print("mode          ms/frame")
+    for dirty in (False, True):
+        game = Game(dirty_rects=dirty)
+        game.sim.start_level(1, 1)
+        game.sim.state = GameState.LEVEL
+        start = time.perf_counter()
+        for tick in range(frames):
+            game.sim.step(scripted_inputs(tick))
+            game.present()
+        elapsed = (time.perf_counter() - start) * 1000 / frames
+        name = "dirty rects" if dirty else "full flip"
+        print(f"{name:11s}   {elapsed:8.3f}")
+
+def bench_camera(widths=(800, 8000, 80000), frames=300):
+    # World 1-1 stretched to each width with a platform, enemy and coin every
+    # 200px, scrolling at running speed from the middle: per-frame drawing
+    # cost should not grow with width
+    print("level width   platforms   enemies   ms/frame")
+    game = Game()
+    for width in widths:
+        game.sim.start_level(1, 1)
+        level = game.sim.current_level
+        level.width = level.platforms[0].width = width
+        for i in range(1, width // 200):
+            level.platforms.append(Platform(i * 200, 150 + (i * 53) % 300, 96, 20, type="brick"))
+            level.enemies.add(i * 200 + 30, 100 + (i * 71) % 300)
+            level.coins.add(i * 200 + 40, 120)
+        level.geometry_changed()
+        start = time.perf_counter()
+        for frame in range(frames):
+            x = min(width // 2 + frame * MOVE_SPEED, width - SCREEN_WIDTH)
+            game.sim.mario.x = game.sim.mario.prev_x = x
+            game.draw()
+        elapsed = (time.perf_counter() - start) * 1000 / frames
+        print(f"{width:11d}   {len(level.platforms):9d}   {len(level.enemies):7d}   {elapsed:8.3f}")
+
+def bench_streaming(lengths=(10, 100, 1000, 10000), ticks=3000):
+    # A level of each length in screens built whole, vs streamed while
+    # running right at twice Mario's speed: build time, traced memory in
+    # use at the end, and the slowest tick
+    print("screens   eager ms   eager KB   streamed ms   streamed KB   worst tick ms")
+    for screens in lengths:
+        source = StairsSource(screens)
+        tracemalloc.start()
+        start = time.perf_counter()
+        level = Level(1, 1, source=source)
+        level.load(0, level.chunk_count())
+        eager = (time.perf_counter() - start) * 1000
+        eager_kb = tracemalloc.get_traced_memory()[0] // 1024
+        del level
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        sim = Simulation()
+        sim.start_level(1, 1, source)
+        streamed = (time.perf_counter() - start) * 1000
+        sim.mario.lives = 10 ** 6
+        worst = 0
+        for tick in range(ticks):
+            sim.mario.x = min(sim.mario.x + MOVE_SPEED, source.width - 200)
+            begin = time.perf_counter()
+            sim.step(Inputs([pygame.K_SPACE] if tick % 30 == 0 else [], False, True))
+            worst = max(worst, time.perf_counter() - begin)
+        streamed_kb = tracemalloc.get_traced_memory()[0] // 1024
+        tracemalloc.stop()
+        print(f"{screens:7d}   {eager:8.1f}   {eager_kb:8d}   {streamed:11.1f}   "
+              f"{streamed_kb:11d}   {worst * 1000:13.2f}")
+
+def bench_level_file(lengths=(1, 100, 1000, 10000)):
+    # Opening a level of each length in screens: mapping its level file and
+    # loading the chunks in view, vs building every platform object, with
+    # tile collision both ways
+    print("screens   file KB   mapped ms   built ms")
+    for screens in lengths:
+        source = StairsSource(screens)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "level.uml")
+            chunks = [source.chunk(index) for index in range(screens)]
+            write_level_file(path, 1, 1, source.width,
+                             [p for chunk in chunks for p in chunk.platforms],
+                             [e for chunk in chunks for e in chunk.enemies],
+                             [c for chunk in chunks for c in chunk.coins],
+                             (source.goal_x, source.goal_y))
+            del chunks
+            size = os.path.getsize(path) // 1024
+            start = time.perf_counter()
+            level = Level(1, 1, True, LevelFile(path))
+            mapped = (time.perf_counter() - start) * 1000
+            del level
+        start = time.perf_counter()
+        level = Level(1, 1, True, source)
+        level.load(0, screens)
+        built = (time.perf_counter() - start) * 1000
+        print(f"{screens:7d}   {size:7d}   {mapped:9.2f}   {built:8.1f}")
+
+def bench_generator(lengths=(20, 200), count=20):
+    # Levels/sec for generating a level's chunks, generating and writing it
+    # to the cache, and opening it from the cache once it's there
+    print("screens   generated/s   cached/s   opened/s")
+    for screens in lengths:
+        start = time.perf_counter()
+        for seed in range(count):
+            level = ProceduralLevel(seed, seed % 5 + 1, seed % 3 + 1, screens)
+            for index in range(screens):
+                level.chunk(index)
+        generated = count / (time.perf_counter() - start)
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            for seed in range(count):
+                generated_level(seed, seed % 5 + 1, seed % 3 + 1, screens, directory)
+            cached = count / (time.perf_counter() - start)
+            start = time.perf_counter()
+            for seed in range(count):
+                generated_level(seed, seed % 5 + 1, seed % 3 + 1, screens, directory)
+            opened = count / (time.perf_counter() - start)
+        print(f"{screens:7d}   {generated:11.1f}   {cached:8.1f}   {opened:8.0f}")
+
+def bench_level_cache(lengths=(20, 200, 2000)):
+    # Main thread time to enter World 1-1 from a level file of a generated
+    # level of each length in screens: built on entry, prefetched while on
+    # the overworld, and entered again from the cache
+    print("screens   built ms   prefetched ms   cached ms")
+    for screens in lengths:
+        with tempfile.TemporaryDirectory() as directory:
+            level = ProceduralLevel(0, 1, 1, screens)
+            chunks = [level.chunk(index) for index in range(screens)]
+            write_level_file(os.path.join(directory, level_file_name(1, 1)), 1, 1, level.width,
+                             [p for chunk in chunks for p in chunk.platforms],
+                             [e for chunk in chunks for e in chunk.enemies],
+                             [c for chunk in chunks for c in chunk.coins],
+                             (level.goal_x, level.goal_y), level.sky)
+            times = []
+            for prefetch in (False, True):
+                sim = Simulation(level_dir=directory)
+                sim.state = GameState.OVERWORLD
+                if prefetch:
+                    sim.step(Inputs())
+                    sim.levels.pending[(1, 1)].result()
+                start = time.perf_counter()
+                sim.step(Inputs([pygame.K_1]))
+                times.append((time.perf_counter() - start) * 1000)
+            sim.step(Inputs([pygame.K_ESCAPE]))
+            start = time.perf_counter()
+            sim.step(Inputs([pygame.K_1]))
+            cached = (time.perf_counter() - start) * 1000
+        print(f"{screens:7d}   {times[0]:8.2f}   {times[1]:13.2f}   {cached:9.2f}")
+
+def bench_rewind(seconds=10):
+    # Capture cost per tick and memory for a full rewind buffer
+    print("scene      push us/tick   history KB   pop us/tick")
+    for name, start in (("level 5-3", lambda sim: sim.start_level(5, 3)),
+                        ("boss 4", lambda sim: sim.start_boss(4))):
+        sim = Simulation(seed=1)
+        start(sim)
+        sim.mario.lives = 10 ** 6
+        buffer = RewindBuffer(seconds)
+        ticks = seconds * 60
+        elapsed = 0
+        for tick in range(ticks):
+            snapshot = sim.snapshot()
+            begin = time.perf_counter()
+            buffer.push(snapshot)
+            elapsed += time.perf_counter() - begin
+            sim.step(scripted_inputs(tick))
+        history = buffer.nbytes() // 1024
+        begin = time.perf_counter()
+        while len(buffer):
+            sim.restore(buffer.pop())
+        popped = (time.perf_counter() - begin) * 1e6 / ticks
+        print(f"{name:9s}   {elapsed * 1e6 / ticks:12.1f}   {history:10d}   {popped:11.1f}")
+
+def bench_env(num_envs=64, steps=300):
+    # Vectorized environment throughput on World 1-2 with random actions
+    print("workers   env steps/s")
+    rng = np.random.default_rng(0)
+    for workers in sorted({0, 1, os.cpu_count() or 1}):
+        env = VecMarioEnv(num_envs, 1, 2, seed=0, workers=workers)
+        env.reset()
+        start = time.perf_counter()
+        for step in range(steps):
+            env.step(rng.integers(6, size=num_envs))
+        rate = num_envs * steps / (time.perf_counter() - start)
+        env.close()
+        print(f"{workers:7d}   {rate:11.0f}")
+
+def bench_raster(batches=(1, 16, 64), frames=50):
+    # 84x84 observations of World 2-1 in play: Game.draw plus a smoothscale
+    # and surfarray copy, vs the NumPy rasterizer over a batch (drawing only)
+    print("sims   pygame us/sim   rasterizer us/sim")
+    game = Game()
+    game.sim.start_level(2, 1)
+    small = pygame.Surface((84, 84))
+    for tick in range(120):
+        game.sim.step(scripted_inputs(tick))
+    start = time.perf_counter()
+    for frame in range(frames):
+        game.draw()
+        pygame.transform.smoothscale(game.screen, (84, 84), small)
+        pygame.surfarray.array3d(small)
+    drawn = (time.perf_counter() - start) * 1e6 / frames
+    rasterizer = Rasterizer(84, 84)
+    for count in batches:
+        sims = []
+        for i in range(count):
+            sim = Simulation(seed=i)
+            sim.start_level(2, 1)
+            sims.append(sim)
+        for tick in range(120):
+            for sim in sims:
+                sim.step(scripted_inputs(tick))
+        start = time.perf_counter()
+        for frame in range(frames):
+            rasterizer.render(sims)
+        rastered = (time.perf_counter() - start) * 1e6 / frames / count
+        print(f"{count:4d}   {drawn:13.1f}   {rastered:17.1f}")
+
+def check_batch(players=100, ticks=600):
+    # MarioBatch against scalar Marios given the same random inputs, on every
+    # world's built-in level and on a generated one with gaps to fall into:
+    # x, y and alive must match exactly after every tick
+    rng = np.random.default_rng(0)
+    deaths = 0
+    for world in range(1, 6):
+        generated = ProceduralLevel(0, world, 3, 4)
+        for platforms, width in ((Level(world, 1).platforms, SCREEN_WIDTH),
+                                 ([p for index in range(4)
+                                   for p in generated.chunk(index).platforms], generated.width)):
+            batch = MarioBatch(players, platforms, level_width=width)
+            marios = [Mario(100, 400) for _ in range(players)]
+            for tick in range(ticks):
+                left, right, jump = rng.random((3, players)) < [[0.2], [0.7], [0.1]]
+                alive = batch.step(left, right, jump)
+                for i, mario in enumerate(marios):
+                    if jump[i]:
+                        mario.jump()
+                    if left[i]:
+                        mario.move_left()
+                    elif right[i]:
+                        mario.move_right()
+                    else:
+                        mario.stop()
+                    survived = mario.update(platforms, width)
+                    assert (mario.x, mario.y, survived) == (batch.x[i], batch.y[i], alive[i]), \
+                        f"world {world} tick {tick} player {i}"
+                    if not survived:
+                        mario.respawn(100, 400)
+                deaths += players - int(alive.sum())
+                batch.respawn(~alive)
+    return f"{players} players x {ticks} ticks on 10 levels, {deaths} falls"
+
+def random_inputs(ticks, seed=0):
+    # Random play, with stage and menu keys now and then
+    rng = random.Random(seed)
+    keys = [pygame.K_RETURN, pygame.K_ESCAPE, pygame.K_q, pygame.K_b, pygame.K_1, pygame.K_2,
+            pygame.K_3, pygame.K_LEFT, pygame.K_RIGHT]
+    held = (False, True)
+    for tick in range(ticks):
+        if rng.random() < 1 / 40:
+            held = rng.choice([(False, False), (True, False), (False, True)])
+        pressed = [pygame.K_SPACE] if rng.random() < 1 / 30 else []
+        if rng.random() < 1 / 500:
+            pressed.append(rng.choice(keys))
+        yield Inputs(pressed, *held)
+
+def check_replay(ticks=20000, seed=7):
+    # Random play on the built-in and on generated levels, recorded and read
+    # back: the inputs must round-trip, and replaying them must end the same
+    # way with the levels taken from the recording. Replaying with other
+    # level options must be refused.
+    sizes = []
+    for generate in (None, (3, 4)):
+        sim = Simulation(seed=seed, generate=generate)
+        recorded = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "check.rep")
+            writer = ReplayWriter(path, seed, generate=generate)
+            for inputs in random_inputs(ticks):
+                writer.record(inputs)
+                sim.step(inputs)
+                recorded.append((inputs.pressed, inputs.left, inputs.right))
+            writer.close()
+            sizes.append(os.path.getsize(path))
+            reader = ReplayReader(path)
+            assert (reader.seed, reader.generate, reader.level_dir) == (seed, generate, False)
+            assert [(i.pressed, i.left, i.right) for i in reader] == recorded, "inputs differ"
+            replayed = play_replay(path)
+            for wrong in ({"generate": (4, 4)}, {"level_dir": directory}):
+                try:
+                    play_replay(path, **wrong)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError(f"replay recorded with {generate} ran with {wrong}")
+        end = lambda sim: (sim.state, sim.ticks, sim.deaths, sim.mario.x, sim.mario.y,
+                           sim.mario.coins, sim.overworld.snapshot())
+        assert end(replayed) == end(sim), f"replay ends {end(replayed)}, run ended {end(sim)}"
+    return f"{ticks} ticks on built-in and generated levels in {sizes[0]} and {sizes[1]} bytes"
+
+def check_snapshot(ticks=6000, every=50):
+    # Random play from a built-in level, a generated, streamed one and a
+    # boss fight, saving state every so often. Restoring each save
+    # afterwards must give back the saved snapshot, and playing on from it
+    # the same ticks as the first time round.
+    inputs = list(random_inputs(ticks, 2))
+    seen = set()
+    for generate, boss in ((None, False), ((3, 4), False), (None, True)):
+        sim = Simulation(seed=7, generate=generate)
+        if boss:
+            sim.start_boss(2)
+        else:
+            sim.start_level(1, 1)
+        saves = []
+        states = []
+        for tick, tick_inputs in enumerate(inputs):
+            if tick % every == 0:
+                saves.append((tick, sim.snapshot()))
+            sim.step(tick_inputs)
+            states.append(sim.snapshot())
+            seen.add(sim.state.name)
+        for start, snapshot in reversed(saves):
+            sim.restore(snapshot)
+            assert sim.snapshot() == snapshot, f"restoring tick {start}"
+            for tick in range(start, min(start + every, ticks)):
+                sim.step(inputs[tick])
+                assert sim.snapshot() == states[tick], \
+                    f"tick {tick} differs after restoring tick {start}"
+    return f"3 runs of {ticks} ticks, {len(saves)} saves each, through {', '.join(sorted(seen))}"
+
+def check_rewind(ticks=6000, seconds=2):
+    # Random play pushing every tick into a RewindBuffer, rewinding 90 ticks
+    # every 500 and playing on from there: each pop must give back what was
+    # pushed, newest first, across keyframes, deltas, stage changes and
+    # streamed chunks, and restore to it
+    rewinds = 0
+    for generate, boss in ((None, False), ((3, 4), False), (None, True)):
+        sim = Simulation(seed=7, generate=generate)
+        if boss:
+            sim.start_boss(2)
+        else:
+            sim.start_level(1, 1)
+        buffer = RewindBuffer(seconds)
+        pushed = []
+        inputs = random_inputs(ticks, 2)
+        for tick, tick_inputs in enumerate(inputs):
+            sim.step(tick_inputs)
+            snapshot = sim.snapshot()
+            buffer.push(snapshot)
+            pushed.append(snapshot)
+            if tick % 500 == 499:
+                for back in range(90):
+                    popped = buffer.pop()
+                    assert popped == pushed.pop(), f"tick {tick}, {back} ticks back"
+                    sim.restore(popped)
+                    assert sim.snapshot() == popped, f"restoring tick {tick}, {back} back"
+                rewinds += 1
+        while len(buffer):
+            assert buffer.pop() == pushed.pop(), "draining the buffer"
+        assert buffer.pop() is None
+    return f"3 runs of {ticks} ticks, {rewinds} rewinds of 90 ticks"
+
+def check_level_file(ticks=3000):
+    # Level files read back as the sources they were written from, chunk by
+    # chunk, and play the same with both kinds of collision; the exported
+    # built-in stages play the same as the built-in ones
+    def contents(chunk):
+        return ([(p.x, p.y, p.width, p.height, tuple(p.color), p.type) for p in chunk.platforms],
+                [tuple(e) for e in chunk.enemies], [tuple(c) for c in chunk.coins])
+
+    def run(sim, start):
+        start(sim)
+        sim.mario.lives = 10 ** 6
+        states = []
+        for tick in range(ticks):
+            sim.step(scripted_inputs(tick) if tick < 600 else
+                     Inputs([pygame.K_SPACE] if tick % 30 == 0 else [], False, True))
+            level = sim.current_level
+            states.append((sim.state, sim.mario.x, sim.mario.y, sim.deaths,
+                           level and (level.enemies.snapshot(), level.coins.snapshot())))
+        return states
+
+    with tempfile.TemporaryDirectory() as directory:
+        for source in (StairsSource(30), ProceduralLevel(5, 3, 2, 30)):
+            path = os.path.join(directory, "level.uml")
+            chunks = [source.chunk(index) for index in range(-(-source.width // CHUNK_WIDTH))]
+            write_level_file(path, 1, 1, source.width,
+                             [p for chunk in chunks for p in chunk.platforms],
+                             [e for chunk in chunks for e in chunk.enemies],
+                             [c for chunk in chunks for c in chunk.coins],
+                             (source.goal_x, source.goal_y), getattr(source, "sky", SKY_BLUE))
+            level_file = LevelFile(path)
+            for index, chunk in enumerate(chunks):
+                assert contents(level_file.chunk(index)) == contents(chunk), \
+                    f"{type(source).__name__} chunk {index}"
+            for tile_collision in (False, True):
+                assert (run(Simulation(tile_collision, 1),
+                            lambda sim: sim.start_level(1, 1, source)) ==
+                        run(Simulation(tile_collision, 1),
+                            lambda sim: sim.start_level(1, 1, LevelFile(path)))), \
+                    f"{type(source).__name__} plays differently from its file"
+            del level_file
+        stages = [(world, level) for world in range(1, 6) for level in (1, 2, 3, None)]
+        list(export(directory))
+        for world, level in stages:
+            if level is None:
+                start = lambda sim: sim.start_boss(world)
+            else:
+                start = lambda sim: sim.start_level(world, level)
+            assert (run(Simulation(seed=1), start) ==
+                    run(Simulation(seed=1, level_dir=directory), start)), \
+                f"exported {world}-{level or 'B'} plays differently"
+    return f"2 streamed sources, {len(stages)} exported stages, {ticks} ticks each"
+
+def streamed_entities(level):
+    # {field: array} of every enemy and of every coin of a streamed level,
+    # loaded or parked
+    found = []
+    for slot, store in enumerate((level.enemies, level.coins)):
+        arrays = [[getattr(store, name)[:store.count] for name in store.fields]]
+        arrays += [store.unpack(rows[slot]) for rows in level.parked.values() if rows[slot]]
+        found.append({name: np.concatenate(field)
+                      for name, field in zip(store.fields, zip(*arrays))})
+    return found
+
+def check_streaming(ticks=4000):
+    # With Mario standing still, enemies walking on flat ground out of the
+    # loaded chunks must be parked rather than fall through the missing
+    # ground: every enemy spawned is still there, and still overlaps the
+    # ground (the tick it stepped out, it sank a little), so it lands again
+    # when its chunk loads
+    for tile_collision in (False, True):
+        sim = Simulation(tile_collision, 1)
+        sim.start_level(1, 1, StairsSource(10))
+        level = sim.current_level
+        for tick in range(ticks):
+            sim.step(Inputs())
+        ys = streamed_entities(level)[0]["y"]
+        assert sim.state == GameState.LEVEL
+        assert len(ys) == 2 * level.spawned, f"{len(ys)} of {2 * level.spawned} enemies left"
+        assert (ys < 500).all(), f"enemy fell to y={ys.max()}"
+
+    # Walking to the far end and back, out of reach above the level, with a
+    # coin collected and an enemy stomped first: at every step each enemy
+    # and coin spawned is loaded or parked, once. At the end every coin is
+    # where its chunk put it, only the collected one collected, and the
+    # stomped enemy is still dead where it fell.
+    source = StairsSource(12)
+    coins = sorted((x, y) for index in range(12) for x, y in source.chunk(index).coins)
+    for tile_collision in (False, True):
+        level = Level(1, 1, tile_collision, source)
+        mario = Mario(100, -5000)
+        level.coins.collected[0] = True
+        collected = (level.coins.x[0], level.coins.y[0])
+        level.enemies.alive[0] = False
+        stomped = (level.enemies.x[0], level.enemies.y[0])
+        for x in list(range(100, level.width, 20)) + list(range(level.width, 99, -20)):
+            mario.x, mario.y, mario.vy = x, -5000, 0
+            level.update(mario)
+            enemies, found = streamed_entities(level)
+            assert len(enemies["x"]) == len(found["x"]) == 2 * level.spawned, \
+                f"at x={x}, {len(enemies['x'])} enemies and {len(found['x'])} coins " \
+                f"for {level.spawned} chunks"
+        assert level.spawned == level.chunk_count()
+        assert sorted(zip(found["x"].tolist(), found["y"].tolist())) == coins
+        shown = found["collected"]
+        assert list(zip(found["x"][shown], found["y"][shown])) == [collected]
+        dead = ~enemies["alive"]
+        assert list(zip(enemies["x"][dead], enemies["y"][dead])) == [stomped]
+
+    # Rasterizing a level whose loaded platforms don't reach the view: the
+    # first screen is empty, and the bricks show up once the view gets there
+    sim = Simulation(seed=1)
+    sim.start_level(1, 1, SparseSource(10))
+    level = sim.current_level
+    rasterizer = Rasterizer()
+    painted = []
+    for x in range(100, level.width, 25):
+        sim.mario.x = x
+        level.stream(x)
+        painted.append(rasterizer.render([sim])[0, 0].any())
+    assert not painted[0] and painted[-1]
+    return (f"idle for {ticks} ticks with {len(ys)} enemies, there and back with "
+            f"{len(enemies['x'])} enemies and {len(found['x'])} coins, sparse level rasterized")
+
+CHECKS = {
+    "batch": check_batch,
+    "replay": check_replay,
+    "snapshot": check_snapshot,
+    "rewind": check_rewind,
+    "level_file": check_level_file,
+    "streaming": check_streaming,
+}
+
+BENCHMARKS = {
+    "broadphase": bench_broadphase,
+    "batch": bench_batch,
+    "entities": bench_entities,
+    "projectiles": bench_projectiles,
+    "static_layer": bench_static_layer,
+    "sprites": bench_sprites,
+    "dirty_rects": bench_dirty_rects,
+    "camera": bench_camera,
+    "streaming": bench_streaming,
+    "level_file": bench_level_file,
+    "generator": bench_generator,
+    "level_cache": bench_level_cache,
+    "rewind": bench_rewind,
+    "env": bench_env,
+    "raster": bench_raster,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or ["check"] + list(BENCHMARKS)
+    for name in names:
+        print(f"== {name} ==")
+        if name == "check":
+            # Each raises AssertionError on a mismatch
+            for check_name, check in CHECKS.items():
+                print(f"{check_name:10s}   ok: {check()}")
+        else:
+            BENCHMARKS[name]()
@@ -5,10 +5,26 @@ A 2D platformer with SMB3 graphics style and BS Satellaview UI
 5 Worlds x 3 Levels + Bowser Jr. Boss Fights
 """
 
+import os
 import sys
+import argparse
+import io
 import math
+import mmap
+import time
+import weakref
+import pickle
 import random
+import struct
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from types import MappingProxyType
+from multiprocessing import Pipe, Process, shared_memory
+
+import numpy as np
 
 # Initialize Pygame FIRST, with explicit font init
 import pygame
@@ -19,9 +35,34 @@ pygame.font.init()  # Explicitly initialize font module to avoid circular import
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 GRAVITY = 0.8
+BOSS_GRAVITY = GRAVITY * 0.7
 JUMP_STRENGTH = -15
 MOVE_SPEED = 5
-FPS = 60
+FPS = 60  # Simulation ticks per second, and the default render rate
+MAX_TICKS_PER_FRAME = 5  # Frame skipping limit before the game slows down
+GRID_CELL_SIZE = 64
+TILE_SIZE = 10  # Every built-in platform edge lies on a 10px boundary
+BULK_UPDATE_MIN = 64  # Below this many entities NumPy call overhead dominates
+FIREBALL_CAPACITY = 256
+FONT_SIZE = 36
+SMALL_FONT_SIZE = 24
+TEXT_CACHE_SIZE = 256
+IDLE_TIMEOUT = 1000  # ms a static screen may go without redrawing
+FIXED_POINT = False  # Set by use_fixed_point()
+FIXED_POINT_SCALE = 256  # Fixed-point physics works in 1/256 px
+REPLAY_MAGIC = b"UM2R"
+REPLAY_VERSION = 2
+REWIND_SECONDS = 10
+REWIND_KEYFRAME_INTERVAL = 60  # Ticks between full snapshots in the rewind buffer
+OBS_ENEMIES = 8  # Enemies, coins and fireballs an environment observation holds
+OBS_COINS = 4
+OBS_FIREBALLS = 8
+CAMERA_LEAD = SCREEN_WIDTH // 3  # Where the camera keeps Mario, from the left edge
+VIEW_CELL_SIZE = 400  # Cell size of the platform grid used to cull drawing
+STATIC_CHUNKS = 4  # Screen-wide static layer chunks kept painted
+CHUNK_WIDTH = SCREEN_WIDTH  # Streamed levels are built and loaded in slices this wide
+STREAM_AHEAD = 2  # Chunks kept loaded past the right edge of the view
+STREAM_BEHIND = 1  # and past the left edge
 
 # Colors (SMB3 palette inspired)
 SKY_BLUE = (146, 189, 221)
@@ -36,6 +77,26 @@ BLACK = (0, 0, 0)
 PURPLE = (128, 0, 128)
 ORANGE = (255, 165, 0)
 
+# Physics constants use_fixed_point() snaps to the fixed-point grid
+FLOAT_PHYSICS = {"GRAVITY": GRAVITY, "BOSS_GRAVITY": BOSS_GRAVITY}
+
+def snap(value):
+    # In fixed-point mode, rounds value onto the fixed-point grid
+    if FIXED_POINT:
+        return round(value * FIXED_POINT_SCALE) / FIXED_POINT_SCALE
+    return value
+
+def use_fixed_point(enabled=True):
+    # Fixed-point physics, process-wide like the constants it rewrites. With
+    # every constant and random velocity a multiple of 1/FIXED_POINT_SCALE,
+    # positions and velocities stay exact binary fractions and no arithmetic
+    # step ever rounds, so results cannot depend on evaluation order (scalar
+    # or NumPy paths) or platform. Gravity becomes 205/256 instead of 0.8.
+    global FIXED_POINT
+    FIXED_POINT = enabled
+    for name, value in FLOAT_PHYSICS.items():
+        globals()[name] = snap(value)
+
 class GameState(Enum):
     OVERWORLD = 1
     LEVEL = 2
@@ -44,8 +105,68 @@ class GameState(Enum):
     VICTORY = 5
     BS_MENU = 6
 
+class SpriteCache:
+    # Each visual state is rasterised once and blitted from then on. Keys are
+    # (kind, state...) tuples; paint(surface, *args) draws the sprite at the
+    # surface origin. The sprites are hard-edged, so a colour key on a
+    # display-format surface (RLE accelerated) stands in for per-pixel alpha
+    # and blits faster.
+    COLORKEY = (255, 0, 255)
+
+    def __init__(self):
+        self.sprites = {}
+
+    def get(self, key, size, paint, *args):
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = pygame.Surface(size)
+            sprite.fill(self.COLORKEY)
+            paint(sprite, *args)
+            if pygame.display.get_surface() is not None:
+                sprite = sprite.convert()
+            sprite.set_colorkey(self.COLORKEY, pygame.RLEACCEL)
+            self.sprites[key] = sprite
+        return sprite
+
+    def clear(self):
+        self.sprites.clear()
+
+SPRITES = SpriteCache()
+
+class TextCache:
+    # Shared font registry plus an LRU cache of rendered text surfaces keyed
+    # by (font, text, colour), so unchanged strings are rendered only once
+    def __init__(self, capacity=TEXT_CACHE_SIZE):
+        self.capacity = capacity
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+
+    def font(self, size, name=None):
+        font = self.fonts.get((name, size))
+        if font is None:
+            font = self.fonts[(name, size)] = pygame.font.Font(name, size)
+        return font
+
+    def render(self, text, size, color, name=None):
+        key = (name, size, text, color)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.font(size, name).render(text, True, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.capacity:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+TEXT = TextCache()
+
 class Mario:
     def __init__(self, x, y):
+        self.respawn(x, y)
+
+    def respawn(self, x, y):
+        # Back to how Mario(x, y) starts, keeping the same object
         self.x = x
         self.y = y
         self.vx = 0
@@ -57,8 +178,14 @@ class Mario:
         self.lives = 3
         self.coins = 0
         self.power_up = 0  # 0=small, 1=big, 2=fire
+        # Position before the last update, for drawing between ticks
+        self.prev_x = x
+        self.prev_y = y
         
-    def update(self, platforms):
+    def update(self, platforms, level_width=SCREEN_WIDTH):
+        self.prev_x = self.x
+        self.prev_y = self.y
+
         # Apply gravity
         self.vy += GRAVITY
         
@@ -68,27 +195,26 @@ class Mario:
         
         # Check platform collisions
         self.on_ground = False
-        for platform in platforms:
-            if self.check_collision(platform):
-                # Landing on top
-                if self.vy > 0 and self.y < platform.y:
-                    self.y = platform.y - self.height
-                    self.vy = 0
-                    self.on_ground = True
-                # Hitting from below
-                elif self.vy < 0 and self.y > platform.y:
-                    self.y = platform.y + platform.height
-                    self.vy = 0
-                # Side collisions
-                elif self.vx > 0:
-                    self.x = platform.x - self.width
-                    self.vx = 0
-                elif self.vx < 0:
-                    self.x = platform.x + platform.width
-                    self.vx = 0
+        for platform in overlapping_platforms(self, platforms):
+            # Landing on top
+            if self.vy > 0 and self.y < platform.y:
+                self.y = platform.y - self.height
+                self.vy = 0
+                self.on_ground = True
+            # Hitting from below
+            elif self.vy < 0 and self.y > platform.y:
+                self.y = platform.y + platform.height
+                self.vy = 0
+            # Side collisions
+            elif self.vx > 0:
+                self.x = platform.x - self.width
+                self.vx = 0
+            elif self.vx < 0:
+                self.x = platform.x + platform.width
+                self.vx = 0
         
-        # Screen boundaries
-        self.x = max(0, min(self.x, SCREEN_WIDTH - self.width))
+        # Level boundaries
+        self.x = max(0, min(self.x, level_width - self.width))
         
         # Death by falling
         if self.y > SCREEN_HEIGHT:
@@ -111,23 +237,136 @@ class Mario:
     def stop(self):
         self.vx = 0
         
+    def snapshot(self):
+        # Every attribute is a plain value
+        return self.__dict__.copy()
+
+    def restore(self, state):
+        self.__dict__.update(state)
+
     def check_collision(self, other):
         return (self.x < other.x + other.width and
                 self.x + self.width > other.x and
                 self.y < other.y + other.height and
                 self.y + self.height > other.y)
                 
-    def draw(self, screen):
+    def position(self, alpha=1.0):
+        # alpha is how far the frame is from the previous tick to the last one
+        back = 1.0 - alpha
+        return (self.x - (self.x - self.prev_x) * back,
+                self.y - (self.y - self.prev_y) * back)
+
+    def draw(self, screen, alpha=1.0, camera_x=0):
+        big = self.power_up >= 1
+        sprite = SPRITES.get(("mario", big, self.facing_right), (self.width, self.height),
+                             Mario.paint, big)
+        x, y = self.position(alpha)
+        return screen.blit(sprite, (x - camera_x, y))
+
+    @staticmethod
+    def paint(surface, big):
         # Draw Mario (simplified)
-        color = MARIO_RED if self.power_up >= 1 else MARIO_BLUE
-        pygame.draw.rect(screen, color, (self.x, self.y, self.width, self.height))
+        color = MARIO_RED if big else MARIO_BLUE
+        pygame.draw.rect(surface, color, (0, 0, 32, 48))
         # Hat
-        pygame.draw.rect(screen, MARIO_RED, (self.x + 8, self.y, 16, 8))
+        pygame.draw.rect(surface, MARIO_RED, (8, 0, 16, 8))
         # Face
-        pygame.draw.rect(screen, (255, 220, 177), (self.x + 8, self.y + 8, 16, 16))
+        pygame.draw.rect(surface, (255, 220, 177), (8, 8, 16, 16))
         # Eyes
-        pygame.draw.rect(screen, BLACK, (self.x + 10, self.y + 12, 4, 4))
-        pygame.draw.rect(screen, BLACK, (self.x + 18, self.y + 12, 4, 4))
+        pygame.draw.rect(surface, BLACK, (10, 12, 4, 4))
+        pygame.draw.rect(surface, BLACK, (18, 12, 4, 4))
+
+class MarioBatch:
+    # Many independent Marios stepped together through one level's platforms.
+    # Positions, velocities and flags live in NumPy arrays and each platform
+    # is resolved for every player at once, in the same order and with the
+    # same rules as Mario.update, so player i matches a scalar Mario exactly.
+    def __init__(self, count, platforms, x=100, y=400, level_width=SCREEN_WIDTH):
+        self.count = count
+        self.platforms = platforms
+        self.level_width = level_width
+        self.width = 32
+        self.height = 48
+        self.start_x = x
+        self.start_y = y
+        self.x = np.full(count, x, dtype=np.float64)
+        self.y = np.full(count, y, dtype=np.float64)
+        self.vx = np.zeros(count)
+        self.vy = np.zeros(count)
+        self.on_ground = np.zeros(count, dtype=bool)
+        self.facing_right = np.ones(count, dtype=bool)
+        self.lives = np.full(count, 3, dtype=np.int32)
+
+    def respawn(self, mask):
+        self.x[mask] = self.start_x
+        self.y[mask] = self.start_y
+        self.vx[mask] = 0
+        self.vy[mask] = 0
+        self.on_ground[mask] = False
+        self.facing_right[mask] = True
+
+    def step(self, left, right, jump):
+        # Boolean arrays, applied in Simulation.step order: jump presses, then
+        # held direction, then physics
+        self.vy[np.asarray(jump, dtype=bool) & self.on_ground] = JUMP_STRENGTH
+        left = np.asarray(left, dtype=bool)
+        right = np.asarray(right, dtype=bool) & ~left
+        self.vx[:] = 0
+        self.vx[left] = -MOVE_SPEED
+        self.vx[right] = MOVE_SPEED
+        self.facing_right[left] = False
+        self.facing_right[right] = True
+        return self.update()
+
+    def update(self):
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        w, h = self.width, self.height
+        vy += GRAVITY
+        x += vx
+        y += vy
+
+        # Check platform collisions, skipping platforms outside the box around
+        # all players (recomputed whenever somebody gets pushed)
+        self.on_ground[:] = False
+        bounds = None
+        for platform in self.platforms:
+            if bounds is None:
+                bounds = (x.min(), x.max() + w, y.min(), y.max() + h)
+            px, py = platform.x, platform.y
+            pw, ph = platform.width, platform.height
+            if (bounds[0] >= px + pw or bounds[1] <= px or
+                    bounds[2] >= py + ph or bounds[3] <= py):
+                continue
+            hit = (x < px + pw) & (x + w > px) & (y < py + ph) & (y + h > py)
+            if not hit.any():
+                continue
+            bounds = None
+            # Landing on top
+            land = hit & (vy > 0) & (y < py)
+            y[land] = py - h
+            vy[land] = 0
+            self.on_ground |= land
+            # Hitting from below
+            hit &= ~land
+            head = hit & (vy < 0) & (y > py)
+            y[head] = py + ph
+            vy[head] = 0
+            # Side collisions
+            hit &= ~head
+            push_left = hit & (vx > 0)
+            x[push_left] = px - w
+            vx[push_left] = 0
+            push_right = hit & ~push_left & (vx < 0)
+            x[push_right] = px + pw
+            vx[push_right] = 0
+
+        # Level boundaries
+        np.clip(x, 0, self.level_width - w, out=x)
+
+        # Death by falling; returns which players are still alive
+        fell = y > SCREEN_HEIGHT
+        self.lives[fell] -= 1
+        return ~fell
 
 class Platform:
     def __init__(self, x, y, width, height, color=GROUND_BROWN, type="solid"):
@@ -138,68 +377,474 @@ class Platform:
         self.color = color
         self.type = type
         
-    def draw(self, screen):
+    def draw(self, screen, camera_x=0):
+        x = self.x - camera_x
         if self.type == "brick":
             # Draw brick pattern
             for i in range(0, self.width, 32):
                 for j in range(0, self.height, 16):
-                    pygame.draw.rect(screen, BRICK_RED, (self.x + i, self.y + j, 30, 14))
-                    pygame.draw.rect(screen, BLACK, (self.x + i, self.y + j, 30, 14), 1)
+                    pygame.draw.rect(screen, BRICK_RED, (x + i, self.y + j, 30, 14))
+                    pygame.draw.rect(screen, BLACK, (x + i, self.y + j, 30, 14), 1)
         elif self.type == "pipe":
-            pygame.draw.rect(screen, PIPE_GREEN, (self.x, self.y, self.width, self.height))
-            pygame.draw.rect(screen, (0, 100, 0), (self.x, self.y, self.width, self.height), 3)
+            pygame.draw.rect(screen, PIPE_GREEN, (x, self.y, self.width, self.height))
+            pygame.draw.rect(screen, (0, 100, 0), (x, self.y, self.width, self.height), 3)
         else:
-            pygame.draw.rect(screen, self.color, (self.x, self.y, self.width, self.height))
+            pygame.draw.rect(screen, self.color, (x, self.y, self.width, self.height))
 
-class Enemy:
-    def __init__(self, x, y, type="goomba"):
+def rects_overlap(a, b):
+    return (a.x < b.x + b.width and
+            a.x + a.width > b.x and
+            a.y < b.y + b.height and
+            a.y + a.height > b.y)
+
+def overlapping_platforms(body, platforms):
+    # Platforms touching body, in list order. Accepts a plain list (full scan),
+    # a PlatformGrid or a TileMap. Overlap is tested lazily so that resolving one
+    # contact moves the body before the next platform is checked.
+    if isinstance(platforms, (PlatformGrid, TileMap)):
+        return platforms.overlapping(body)
+    return (platform for platform in platforms if rects_overlap(body, platform))
+
+class PlatformGrid:
+    # Uniform-grid broadphase built once per level. Each cell lists the indices
+    # of the platforms touching it, so a body only tests the platforms in the
+    # cells it overlaps instead of every platform in the level.
+    def __init__(self, platforms, cell_size=GRID_CELL_SIZE):
+        self.platforms = platforms
+        self.cell_size = cell_size
+        self.rebuild()
+
+    def rebuild(self):
+        # Call after adding, removing or moving platforms
+        self.cells = {}
+        for i, platform in enumerate(self.platforms):
+            for cell in self.cells_for(platform.x, platform.y, platform.width, platform.height):
+                self.cells.setdefault(cell, []).append(i)
+        self.rects = np.array([(p.x, p.y, p.width, p.height) for p in self.platforms],
+                              dtype=np.float64).reshape(-1, 4)
+
+    def cells_for(self, x, y, width, height):
+        size = self.cell_size
+        for cx in range(int(x // size), int((x + width) // size) + 1):
+            for cy in range(int(y // size), int((y + height) // size) + 1):
+                yield (cx, cy)
+
+    def candidates(self, x, y, width, height):
+        # Sorted platform indices from every cell the box touches
+        found = set()
+        for cell in self.cells_for(x, y, width, height):
+            bucket = self.cells.get(cell)
+            if bucket:
+                found.update(bucket)
+        return sorted(found)
+
+    def first_contacts(self, x, y, width, height):
+        # For arrays of same-sized boxes, the lowest index of a platform each
+        # box overlaps, or -1. Tested in slices of the candidate list to keep
+        # the boxes x platforms overlap matrix small.
+        first = np.full(len(x), -1, dtype=np.int64)
+        if not len(x):
+            return first
+        candidates = np.array(self.candidates(x.min(), y.min(), x.max() + width - x.min(),
+                                              y.max() + height - y.min()), dtype=np.int64)
+        step = max(1, (1 << 20) // len(x))
+        for start in range(0, len(candidates), step):
+            index = candidates[start:start + step]
+            px, py, pw, ph = self.rects[index].T
+            hit = ((x[:, None] < px + pw) & (x[:, None] + width > px) &
+                   (y[:, None] < py + ph) & (y[:, None] + height > py))
+            found = (first < 0) & hit.any(axis=1)
+            first[found] = index[hit[found].argmax(axis=1)]
+        return first
+
+    def overlapping(self, body):
+        # Same order and results as scanning the full list: after each contact
+        # the body may have been pushed, so the neighbourhood is queried again
+        last = -1
+        while True:
+            hit = None
+            for i in self.candidates(body.x, body.y, body.width, body.height):
+                if i > last and rects_overlap(body, self.platforms[i]):
+                    hit = i
+                    break
+            if hit is None:
+                return
+            last = hit
+            yield self.platforms[hit]
+
+class TileMap:
+    # Optional tile-grid collision. Platforms are rasterised once into a
+    # grid of solid tiles plus the index of the platform owning each tile
+    # (the first one in the list wins). A body finds its contacts with a
+    # few cell lookups, so the cost is the same however many platforms the
+    # level has. Platform edges that are off the tile grid are rounded outwards.
+    # The grid starts at the leftmost platform's column, so a streamed level
+    # only pays for the stretch that is loaded. Tiles are stored column by
+    # column, which keeps any stretch of columns contiguous: load() can take
+    # grids straight from a mapped level file.
+    def __init__(self, platforms, tile_size=TILE_SIZE):
+        self.platforms = platforms
+        self.tile_size = tile_size
+        self.rows = -(-SCREEN_HEIGHT // tile_size)
+        self.rebuild()
+
+    def rebuild(self):
+        # Call after adding, removing or moving platforms
+        size, rows = self.tile_size, self.rows
+        left = max(0, int(min([p.x for p in self.platforms], default=0) // size))
+        right = max([SCREEN_WIDTH] + [p.x + p.width for p in self.platforms])
+        cols = -(-int(right) // size) - left
+        solid = bytearray(cols * rows)
+        owner = array("I", bytes(4 * len(solid)))
+        for index in range(len(self.platforms) - 1, -1, -1):
+            p = self.platforms[index]
+            x0 = max(0, int(p.x // size) - left)
+            x1 = min(cols, math.ceil((p.x + p.width) / size) - left)
+            y0 = max(0, int(p.y // size))
+            y1 = min(rows, math.ceil((p.y + p.height) / size))
+            if x1 <= x0 or y1 <= y0:
+                continue
+            for tx in range(x0, x1):
+                col = tx * rows
+                solid[col + y0:col + y1] = b"\x01" * (y1 - y0)
+                owner[col + y0:col + y1] = array("I", [index]) * (y1 - y0)
+        rects = np.array([(p.x, p.y, p.width, p.height) for p in self.platforms],
+                         dtype=np.float64).reshape(-1, 4)
+        self.load(left, solid, owner, rects)
+
+    def load(self, left, solid, owner, rects, offset=0, base=0):
+        # Use ready-made grids of columns from left on: solid is any buffer
+        # with find() (a bytearray or mmap) whose tiles start at offset, and
+        # owner a typed buffer of platform indices counted from base. rects
+        # are the platforms' (x, y, width, height) rows.
+        self.left = left
+        self.solid = solid
+        self.offset = offset
+        self.owner = owner
+        self.base = base
+        self.cols = len(owner) // self.rows
+        self.rects = rects
+
+    def contact(self, body, last):
+        # Lowest platform index above last owning a solid tile under body
+        size, rows, left = self.tile_size, self.rows, self.left
+        x0 = max(0, int(body.x // size) - left)
+        x1 = min(self.cols, math.ceil((body.x + body.width) / size) - left)
+        y0 = max(0, int(body.y // size))
+        y1 = min(rows, math.ceil((body.y + body.height) / size))
+        if y1 <= y0:
+            return None
+        solid, owner, offset, base = self.solid, self.owner, self.offset, self.base
+        hit = None
+        for tx in range(x0, x1):
+            col = offset + tx * rows
+            i = solid.find(b"\x01", col + y0, col + y1)
+            while i != -1:
+                index = owner[i - offset] - base
+                if index > last and (hit is None or index < hit):
+                    hit = index
+                i = solid.find(b"\x01", i + 1, col + y1)
+        return hit
+
+    def first_contacts(self, x, y, width, height):
+        # Vectorised contact() for arrays of same-sized boxes: the lowest
+        # owning platform index under each box, or -1
+        size, cols, rows = self.tile_size, self.cols, self.rows
+        solid = np.frombuffer(self.solid, dtype=np.uint8, count=cols * rows,
+                              offset=self.offset).reshape(cols, rows)
+        owner = np.asarray(self.owner).reshape(cols, rows)
+        x0 = np.floor_divide(x, size).astype(np.int64) - self.left
+        x1 = np.ceil((x + width) / size).astype(np.int64) - self.left
+        y0 = np.floor_divide(y, size).astype(np.int64)
+        y1 = np.ceil((y + height) / size).astype(np.int64)
+        none = np.iinfo(np.int64).max
+        first = np.full(len(x), none, dtype=np.int64)
+        for dy in range(math.ceil(height / size) + 1):
+            ty = y0 + dy
+            row_ok = (ty < y1) & (ty >= 0) & (ty < rows)
+            ty = np.clip(ty, 0, rows - 1)
+            for dx in range(math.ceil(width / size) + 1):
+                tx = x0 + dx
+                ok = row_ok & (tx < x1) & (tx >= 0) & (tx < cols)
+                tx = np.clip(tx, 0, cols - 1)
+                ok &= solid[tx, ty].astype(bool)
+                np.minimum(first, owner[tx, ty].astype(np.int64) - self.base, out=first, where=ok)
+        first[first == none] = -1
+        return first
+
+    def overlapping(self, body):
+        # Same order as scanning the full list, re-read after each contact
+        last = -1
+        while True:
+            hit = self.contact(body, last)
+            if hit is None:
+                return
+            last = hit
+            yield self.platforms[hit]
+
+ENEMY_TYPES = ["goomba", "koopa"]
+
+def store_field(name, cast):
+    # Property reading and writing one slot of a store's array
+    def get(view):
+        return cast(getattr(view.store, name)[view.index])
+    def set(view, value):
+        getattr(view.store, name)[view.index] = value
+    return property(get, set)
+
+class Body:
+    # Bare box for collision queries
+    __slots__ = ("x", "y", "width", "height")
+
+    def __init__(self, x, y, width, height):
         self.x = x
         self.y = y
-        self.width = 32
-        self.height = 32
-        self.vx = -2
-        self.vy = 0
-        self.type = type
-        self.alive = True
-        
-    def update(self, platforms):
-        if not self.alive:
-            return
-            
-        self.vy += GRAVITY
-        self.x += self.vx
-        self.y += self.vy
-        
-        # Platform collision
-        for platform in platforms:
-            if (self.x < platform.x + platform.width and
-                self.x + self.width > platform.x and
-                self.y < platform.y + platform.height and
-                self.y + self.height > platform.y):
-                if self.vy > 0:
-                    self.y = platform.y - self.height
-                    self.vy = 0
-                    
-        # Reverse at edges
-        if self.x <= 0 or self.x >= SCREEN_WIDTH - self.width:
-            self.vx *= -1
-            
-    def draw(self, screen):
-        if not self.alive:
-            return
-        if self.type == "goomba":
+        self.width = width
+        self.height = height
+
+class EntityStore:
+    # Structure-of-arrays storage: one NumPy array per field, grown by
+    # doubling. Iterating or indexing yields lightweight views.
+    fields = {}
+    view = None
+
+    def __init__(self, capacity=16):
+        self.count = 0
+        for name, dtype in self.fields.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+    def reserve(self, count):
+        # Grow, by doubling, to hold count entities
+        capacity = len(getattr(self, next(iter(self.fields))))
+        if count > capacity:
+            while capacity < count:
+                capacity *= 2
+            for name in self.fields:
+                old = getattr(self, name)
+                new = np.zeros(capacity, dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+
+    def append(self, **values):
+        self.reserve(self.count + 1)
+        i = self.count
+        for name, value in values.items():
+            getattr(self, name)[i] = value
+        self.count += 1
+        return self.view(self, i)
+
+    def __len__(self):
+        return self.count
+
+    def compact(self, keep):
+        # Drop the entities where the boolean array keep is False, keeping
+        # the order of the rest
+        n = self.count
+        kept = int(np.count_nonzero(keep))
+        for name in self.fields:
+            field = getattr(self, name)
+            field[:kept] = field[:n][keep]
+        self.count = kept
+
+    def snapshot(self):
+        # Raw bytes: immutable, and cheaper than arrays to pickle
+        n = self.count
+        return n, [getattr(self, name)[:n].tobytes() for name in self.fields]
+
+    def restore(self, state):
+        # Arrays never shrink, so the snapshot always fits
+        n, arrays = state
+        for name, saved in zip(self.fields, arrays):
+            field = getattr(self, name)
+            field[:n] = np.frombuffer(saved, dtype=field.dtype)
+        self.count = n
+
+    def rows(self, mask, rows=None):
+        # The entities under the boolean array mask packed as (count, bytes),
+        # field after field, following those of earlier rows if given
+        n = self.count
+        fields = [getattr(self, name)[:n][mask] for name in self.fields]
+        if rows is not None:
+            fields = [np.concatenate((old, new)) for old, new in zip(self.unpack(rows), fields)]
+        return len(fields[0]), b"".join(field.tobytes() for field in fields)
+
+    def unpack(self, rows):
+        # The field arrays of rows() data
+        n, data = rows
+        arrays = []
+        offset = 0
+        for name in self.fields:
+            dtype = getattr(self, name).dtype
+            arrays.append(np.frombuffer(data, dtype, n, offset))
+            offset += dtype.itemsize * n
+        return arrays
+
+    def extend(self, rows):
+        # Append the entities packed by rows()
+        n = rows[0]
+        self.reserve(self.count + n)
+        for name, array in zip(self.fields, self.unpack(rows)):
+            getattr(self, name)[self.count:self.count + n] = array
+        self.count += n
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.view(self, i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.view(self, i)
+
+    def touching(self, body, mask):
+        # Indices, in order, of entities under mask overlapping body
+        n = self.count
+        if n < BULK_UPDATE_MIN:
+            w, h = self.width, self.height
+            return [i for i, (x, y, m) in enumerate(zip(self.x[:n].tolist(), self.y[:n].tolist(),
+                                                        mask.tolist()))
+                    if m and x < body.x + body.width and x + w > body.x and
+                    y < body.y + body.height and y + h > body.y]
+        x, y = self.x[:n], self.y[:n]
+        hit = (mask & (x < body.x + body.width) & (x + self.width > body.x) &
+               (y < body.y + body.height) & (y + self.height > body.y))
+        return np.nonzero(hit)[0]
+
+    def visible(self, mask, left, right, x=None):
+        # Indices, in order, of entities under mask reaching into the columns
+        # from left to right, for culling drawing to the view; x gives their
+        # left edges if not self.x
+        if x is None:
+            x = self.x[:self.count]
+        return np.flatnonzero(mask & (x + self.width > left) & (x < right))
+
+class Enemy:
+    # View of one enemy in an EnemyStore, which draws them all at once
+    __slots__ = ("store", "index")
+    width = 32
+    height = 32
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    x = store_field("x", float)
+    y = store_field("y", float)
+    vx = store_field("vx", float)
+    vy = store_field("vy", float)
+    alive = store_field("alive", bool)
+
+    @property
+    def type(self):
+        return ENEMY_TYPES[self.store.kind[self.index]]
+
+    @type.setter
+    def type(self, value):
+        self.store.kind[self.index] = ENEMY_TYPES.index(value)
+
+    @staticmethod
+    def sprite(type):
+        return SPRITES.get(("enemy", type), (Enemy.width, Enemy.height), Enemy.paint, type)
+
+    @staticmethod
+    def paint(surface, type):
+        if type == "goomba":
             # Goomba body
-            pygame.draw.ellipse(screen, (139, 90, 43), (self.x, self.y + 8, self.width, 24))
+            pygame.draw.ellipse(surface, (139, 90, 43), (0, 8, 32, 24))
             # Feet
-            pygame.draw.ellipse(screen, BLACK, (self.x + 4, self.y + 24, 10, 8))
-            pygame.draw.ellipse(screen, BLACK, (self.x + 18, self.y + 24, 10, 8))
-        elif self.type == "koopa":
+            pygame.draw.ellipse(surface, BLACK, (4, 24, 10, 8))
+            pygame.draw.ellipse(surface, BLACK, (18, 24, 10, 8))
+        elif type == "koopa":
             # Koopa shell
-            pygame.draw.ellipse(screen, (0, 180, 0), (self.x, self.y + 4, self.width, 28))
-            pygame.draw.ellipse(screen, (0, 255, 0), (self.x + 4, self.y + 8, 24, 20))
+            pygame.draw.ellipse(surface, (0, 180, 0), (0, 4, 32, 28))
+            pygame.draw.ellipse(surface, (0, 255, 0), (4, 8, 24, 20))
+
+class EnemyStore(EntityStore):
+    # All of a level's enemies, updated together. prev_x and prev_y hold the
+    # positions before the last update, for drawing between ticks.
+    fields = {"x": np.float64, "y": np.float64, "vx": np.float64,
+              "vy": np.float64, "kind": np.uint8, "alive": np.bool_,
+              "prev_x": np.float64, "prev_y": np.float64}
+    view = Enemy
+    width = Enemy.width
+    height = Enemy.height
+
+    def add(self, x, y, type="goomba"):
+        return self.append(x=x, y=y, vx=-2, vy=0,
+                           kind=ENEMY_TYPES.index(type), alive=True, prev_x=x, prev_y=y)
+
+    def update(self, collision, level_width=SCREEN_WIDTH):
+        n = self.count
+        self.prev_x[:n] = self.x[:n]
+        self.prev_y[:n] = self.y[:n]
+        if n < BULK_UPDATE_MIN:
+            self.update_each(collision, level_width)
+            return
+        x, y, vx, vy = self.x[:n], self.y[:n], self.vx[:n], self.vy[:n]
+        alive = self.alive[:n]
+        w, h = self.width, self.height
+        np.add(vy, GRAVITY, out=vy, where=alive)
+        np.add(x, vx, out=x, where=alive)
+        np.add(y, vy, out=y, where=alive)
+
+        # Platform collision: a falling enemy lands on the first platform in
+        # list order that it overlaps
+        falling = alive & (vy > 0)
+        if falling.any():
+            first = collision.first_contacts(x[falling], y[falling], w, h)
+            land = np.nonzero(falling)[0][first >= 0]
+            y[land] = collision.rects[first[first >= 0], 1] - h
+            vy[land] = 0
+
+        # Reverse at edges
+        edge = alive & ((x <= 0) | (x >= level_width - w))
+        vx[edge] *= -1
+
+    def position(self, alpha=1.0):
+        # Arrays of x and y alpha of the way from the previous tick to the
+        # last one, as for Mario.position
+        n = self.count
+        back = 1.0 - alpha
+        x, y = self.x[:n], self.y[:n]
+        return x - (x - self.prev_x[:n]) * back, y - (y - self.prev_y[:n]) * back
+
+    def draw(self, screen, camera_x=0, alpha=1.0):
+        # Returns the rects drawn
+        sprites = [Enemy.sprite(type) for type in ENEMY_TYPES]
+        x, y = self.position(alpha)
+        shown = self.visible(self.alive[:self.count], camera_x, camera_x + screen.get_width(), x)
+        return screen.blits([(sprites[kind], (x - camera_x, y)) for x, y, kind in
+                             zip(x[shown].tolist(), y[shown].tolist(),
+                                 self.kind[shown].tolist())])
+
+    def update_each(self, collision, level_width=SCREEN_WIDTH):
+        # Same rules one enemy at a time, on plain Python floats
+        n = self.count
+        xs, ys = self.x[:n].tolist(), self.y[:n].tolist()
+        vxs, vys = self.vx[:n].tolist(), self.vy[:n].tolist()
+        body = Body(0, 0, self.width, self.height)
+        for i, alive in enumerate(self.alive[:n].tolist()):
+            if not alive:
+                continue
+            vy = vys[i] + GRAVITY
+            body.x = xs[i] = xs[i] + vxs[i]
+            body.y = ys[i] + vy
+
+            # Platform collision
+            for platform in overlapping_platforms(body, collision):
+                if vy > 0:
+                    body.y = platform.y - body.height
+                    vy = 0
+            ys[i], vys[i] = body.y, vy
+
+            # Reverse at edges
+            if body.x <= 0 or body.x >= level_width - body.width:
+                vxs[i] *= -1
+        self.x[:n], self.y[:n] = xs, ys
+        self.vx[:n], self.vy[:n] = vxs, vys
 
 class BowserJr:
-    def __init__(self, x, y):
+    def __init__(self, x, y, rng=random):
         self.x = x
         self.y = y
         self.width = 64
@@ -209,9 +854,25 @@ class BowserJr:
         self.hp = 3
         self.attack_timer = 0
         self.jump_timer = 0
-        self.fireballs = []
+        self.fireballs = ProjectilePool(FIREBALL_CAPACITY)
+        self.rng = rng
+        # Position before the last update, for drawing between ticks
+        self.prev_x = x
+        self.prev_y = y
         
+    def snapshot(self):
+        return (self.x, self.y, self.vx, self.vy, self.hp, self.attack_timer,
+                self.jump_timer, self.prev_x, self.prev_y, self.fireballs.snapshot())
+
+    def restore(self, state):
+        (self.x, self.y, self.vx, self.vy, self.hp, self.attack_timer,
+         self.jump_timer, self.prev_x, self.prev_y, fireballs) = state
+        self.fireballs.restore(fireballs)
+
     def update(self, mario, platforms):
+        self.prev_x = self.x
+        self.prev_y = self.y
+
         # AI behavior
         self.attack_timer += 1
         self.jump_timer += 1
@@ -229,111 +890,642 @@ class BowserJr:
             
         # Shoot fireballs
         if self.attack_timer > 90:
-            self.fireballs.append(Fireball(self.x + self.width//2, self.y + self.height//2, 
-                                          1 if mario.x > self.x else -1))
+            direction = 1 if mario.x > self.x else -1
+            self.fireballs.spawn(self.x + self.width//2, self.y + self.height//2,
+                                 direction * 5, snap(self.rng.uniform(-2, 2)))
             self.attack_timer = 0
             
         # Physics
-        self.vy += GRAVITY * 0.7
+        self.vy += BOSS_GRAVITY
         self.x += self.vx
         self.y += self.vy
         
         # Platform collision
-        for platform in platforms:
-            if (self.x < platform.x + platform.width and
-                self.x + self.width > platform.x and
-                self.y < platform.y + platform.height and
-                self.y + self.height > platform.y):
-                if self.vy > 0:
-                    self.y = platform.y - self.height
-                    self.vy = 0
+        for platform in overlapping_platforms(self, platforms):
+            if self.vy > 0:
+                self.y = platform.y - self.height
+                self.vy = 0
                     
         # Update fireballs
-        for fireball in self.fireballs[:]:
-            fireball.update()
-            if fireball.x < 0 or fireball.x > SCREEN_WIDTH:
-                self.fireballs.remove(fireball)
+        self.fireballs.update()
                 
-    def draw(self, screen):
+    def position(self, alpha=1.0):
+        # As for Mario.position
+        back = 1.0 - alpha
+        return (self.x - (self.x - self.prev_x) * back,
+                self.y - (self.y - self.prev_y) * back)
+
+    def draw(self, screen, alpha=1.0):
+        # Sprite origin is 20px above the body to fit the hair tuft
+        x, y = self.position(alpha)
+        sprite = SPRITES.get(("bowser_jr",), (self.width, self.height + 20), BowserJr.paint)
+        rects = [screen.blit(sprite, (x, y - 20))]
+
+        # Draw fireballs
+        rects += self.fireballs.draw(screen, alpha)
+
+        # HP bar
+        hp = max(0, self.hp)
+        bar = SPRITES.get(("bowser_jr_hp", hp), (64, 8), BowserJr.paint_hp, hp)
+        rects.append(screen.blit(bar, (x, y - 25)))
+        return rects
+
+    @staticmethod
+    def paint(surface):
         # Draw Bowser Jr (simplified)
         # Body
-        pygame.draw.ellipse(screen, (0, 180, 0), (self.x, self.y, self.width, self.height))
+        pygame.draw.ellipse(surface, (0, 180, 0), (0, 20, 64, 64))
         # Shell spikes
         for i in range(3):
-            x = self.x + 16 + i * 16
-            y = self.y + 20
-            pygame.draw.polygon(screen, WHITE, [(x, y), (x-5, y+10), (x+5, y+10)])
+            x = 16 + i * 16
+            y = 40
+            pygame.draw.polygon(surface, WHITE, [(x, y), (x-5, y+10), (x+5, y+10)])
         # Head
-        pygame.draw.ellipse(screen, (255, 220, 177), (self.x + 16, self.y - 10, 32, 32))
+        pygame.draw.ellipse(surface, (255, 220, 177), (16, 10, 32, 32))
         # Hair tuft
-        pygame.draw.polygon(screen, ORANGE, [(self.x + 32, self.y - 10), 
-                                            (self.x + 28, self.y - 20), 
-                                            (self.x + 36, self.y - 20)])
+        pygame.draw.polygon(surface, ORANGE, [(32, 10), (28, 0), (36, 0)])
         # Eyes
-        pygame.draw.circle(screen, BLACK, (self.x + 24, self.y + 4), 3)
-        pygame.draw.circle(screen, BLACK, (self.x + 40, self.y + 4), 3)
-        
-        # Draw fireballs
-        for fireball in self.fireballs:
-            fireball.draw(screen)
-            
-        # HP bar
-        pygame.draw.rect(screen, BLACK, (self.x, self.y - 25, 64, 8))
-        pygame.draw.rect(screen, (255, 0, 0), (self.x + 1, self.y - 24, 20 * self.hp, 6))
+        pygame.draw.circle(surface, BLACK, (24, 24), 3)
+        pygame.draw.circle(surface, BLACK, (40, 24), 3)
+
+    @staticmethod
+    def paint_hp(surface, hp):
+        pygame.draw.rect(surface, BLACK, (0, 0, 64, 8))
+        pygame.draw.rect(surface, (255, 0, 0), (1, 1, 20 * hp, 6))
 
 class Fireball:
-    def __init__(self, x, y, direction):
-        self.x = x
-        self.y = y
-        self.vx = direction * 5
-        self.vy = random.uniform(-2, 2)
-        
+    # View of one live projectile in a ProjectilePool, which draws them all
+    # at once
+    __slots__ = ("store", "index")
+    radius = 6
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    x = store_field("x", float)
+    y = store_field("y", float)
+    vx = store_field("vx", float)
+    vy = store_field("vy", float)
+
+    @staticmethod
+    def sprite():
+        return SPRITES.get(("fireball",), (12, 12), Fireball.paint)
+
+    @staticmethod
+    def paint(surface):
+        pygame.draw.circle(surface, ORANGE, (6, 6), 6)
+        pygame.draw.circle(surface, (255, 255, 0), (6, 6), 4)
+
+class ProjectilePool:
+    # Fixed-capacity projectile arrays. Spawning pops a slot off a free stack
+    # and culling pushes it back, so shots never allocate; motion, off-screen
+    # culling and hit tests run over the whole pool at once. prev_x and
+    # prev_y hold the positions before the last update, for drawing between
+    # ticks.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.vx = np.zeros(capacity)
+        self.vy = np.zeros(capacity)
+        self.prev_x = np.zeros(capacity)
+        self.prev_y = np.zeros(capacity)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.free = np.arange(capacity - 1, -1, -1)
+        self.free_count = capacity
+
+    def __len__(self):
+        return self.capacity - self.free_count
+
+    def __iter__(self):
+        for i in np.flatnonzero(self.active).tolist():
+            yield Fireball(self, i)
+
+    def spawn(self, x, y, vx, vy):
+        # Returns False if the pool is full and the shot was dropped
+        if not self.free_count:
+            return False
+        self.free_count -= 1
+        i = self.free[self.free_count]
+        self.x[i], self.y[i] = x, y
+        self.prev_x[i], self.prev_y[i] = x, y
+        self.vx[i], self.vy[i] = vx, vy
+        self.active[i] = True
+        return True
+
+    def spawn_many(self, x, y, vx, vy):
+        # Array version of spawn for whole patterns; returns how many fit
+        count = min(len(x), self.free_count)
+        slots = self.free[self.free_count - count:self.free_count]
+        self.free_count -= count
+        self.x[slots], self.y[slots] = x[:count], y[:count]
+        self.prev_x[slots], self.prev_y[slots] = x[:count], y[:count]
+        self.vx[slots], self.vy[slots] = vx[:count], vy[:count]
+        self.active[slots] = True
+        return count
+
+    def kill(self, slots):
+        self.active[slots] = False
+        self.vx[slots] = 0
+        self.vy[slots] = 0
+        self.free[self.free_count:self.free_count + len(slots)] = slots
+        self.free_count += len(slots)
+
+    def clear(self):
+        self.kill(np.flatnonzero(self.active))
+
+    def arrays(self):
+        return (self.x, self.y, self.vx, self.vy, self.prev_x, self.prev_y, self.active,
+                self.free)
+
+    def snapshot(self):
+        return [a.tobytes() for a in self.arrays()], self.free_count
+
+    def restore(self, state):
+        arrays, self.free_count = state
+        for a, saved in zip(self.arrays(), arrays):
+            a[:] = np.frombuffer(saved, dtype=a.dtype)
+
     def update(self):
+        if self.free_count == self.capacity:
+            return
+        self.prev_x[:] = self.x
+        self.prev_y[:] = self.y
         self.x += self.vx
         self.y += self.vy
-        
-    def draw(self, screen):
-        pygame.draw.circle(screen, ORANGE, (int(self.x), int(self.y)), 6)
-        pygame.draw.circle(screen, (255, 255, 0), (int(self.x), int(self.y)), 4)
+        gone = self.active & ((self.x < 0) | (self.x > SCREEN_WIDTH) |
+                              (self.y < 0) | (self.y > SCREEN_HEIGHT))
+        self.kill(np.flatnonzero(gone))
+
+    def draw(self, screen, alpha=1.0):
+        # Drawn alpha of the way from the previous tick to the last one, as
+        # for Mario.position
+        live = np.flatnonzero(self.active)
+        back = 1.0 - alpha
+        x, y = self.x[live], self.y[live]
+        x -= (x - self.prev_x[live]) * back
+        y -= (y - self.prev_y[live]) * back
+        sprite = Fireball.sprite()
+        return screen.blits([(sprite, (x - 6, y - 6)) for x, y in
+                             zip(x.astype(int).tolist(), y.astype(int).tolist())])
+
+    def hits(self, x, y, reach):
+        # Slots of live projectiles closer than reach to (x, y) on both axes
+        return np.flatnonzero(self.active & (np.abs(self.x - x) < reach) &
+                              (np.abs(self.y - y) < reach))
 
 class Coin:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.width = 24
-        self.height = 24
-        self.collected = False
-        self.animation = 0
-        
-    def update(self):
-        self.animation = (self.animation + 1) % 60
-        
-    def draw(self, screen):
-        if not self.collected:
-            # Animated coin
-            scale = 1 + math.sin(self.animation * 0.1) * 0.1
-            w = int(self.width * scale)
-            h = int(self.height * scale)
-            pygame.draw.ellipse(screen, COIN_YELLOW, 
-                              (self.x - (w-self.width)//2, self.y - (h-self.height)//2, w, h))
-            pygame.draw.ellipse(screen, (255, 255, 0), 
-                              (self.x + 4, self.y + 4, w - 8, h - 8))
+    # View of one coin in a CoinStore, which draws them all at once
+    __slots__ = ("store", "index")
+    width = 24
+    height = 24
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    x = store_field("x", float)
+    y = store_field("y", float)
+    collected = store_field("collected", bool)
+    animation = store_field("animation", int)
+
+    @staticmethod
+    def sprite(animation):
+        # 28x28 with a 2px margin for the largest frame
+        return SPRITES.get(("coin", animation), (28, 28), Coin.paint, animation)
+
+    @staticmethod
+    def paint(surface, animation):
+        # Animated coin
+        scale = 1 + math.sin(animation * 0.1) * 0.1
+        w = int(Coin.width * scale)
+        h = int(Coin.height * scale)
+        pygame.draw.ellipse(surface, COIN_YELLOW, 
+                          (2 - (w-Coin.width)//2, 2 - (h-Coin.height)//2, w, h))
+        pygame.draw.ellipse(surface, (255, 255, 0), 
+                          (6, 6, w - 8, h - 8))
+
+class CoinStore(EntityStore):
+    # All of a level's coins, updated together
+    fields = {"x": np.float64, "y": np.float64, "collected": np.bool_,
+              "animation": np.uint8}
+    view = Coin
+    width = Coin.width
+    height = Coin.height
+
+    def add(self, x, y):
+        return self.append(x=x, y=y, collected=False, animation=0)
+
+    def draw(self, screen, camera_x=0):
+        # Returns the rects drawn. Sprites have a 2px margin.
+        shown = self.visible(~self.collected[:self.count], camera_x - 2,
+                             camera_x + screen.get_width() + 2)
+        return screen.blits([(Coin.sprite(animation), (x - 2 - camera_x, y - 2))
+                             for x, y, animation in
+                             zip(self.x[shown].tolist(), self.y[shown].tolist(),
+                                 self.animation[shown].tolist())])
+
+    def update(self, mario):
+        # Returns how many coins mario picked up
+        n = self.count
+        animation = self.animation[:n]
+        animation += 1
+        animation[animation == 60] = 0
+        picked = self.touching(mario, ~self.collected[:n])
+        self.collected[picked] = True
+        return len(picked)
+
+class StaticLayer:
+    # Geometry that never moves, painted into screen-sized display-format
+    # chunks laid side by side along the level. Each frame blits the one or
+    # two chunks under the camera, painting them on first sight; the last
+    # STATIC_CHUNKS used are kept. invalidate() forces a repaint.
+    COLORKEY = (255, 0, 255)
+
+    def __init__(self):
+        self.chunks = OrderedDict()  # chunk index -> surface
+        self.size = None
+        self.version = 0
+
+    def invalidate(self):
+        self.chunks.clear()
+        self.version += 1
+
+    def draw(self, screen, paint, camera_x=0):
+        # paint(surface, camera_x) draws the geometry seen from camera_x
+        width, height = screen.get_size()
+        if self.size != (width, height):
+            self.chunks.clear()
+            self.size = (width, height)
+        camera_x = int(camera_x)
+        for index in range(camera_x // width, (camera_x + width - 1) // width + 1):
+            surface = self.chunks.get(index)
+            if surface is None:
+                surface = pygame.Surface((width, height))
+                surface.fill(self.COLORKEY)
+                paint(surface, index * width)
+                if pygame.display.get_surface() is not None:
+                    surface = surface.convert()
+                surface.set_colorkey(self.COLORKEY, pygame.RLEACCEL)
+                self.chunks[index] = surface
+            self.chunks.move_to_end(index)
+            screen.blit(surface, (index * width - camera_x, 0))
+        while len(self.chunks) > STATIC_CHUNKS:
+            self.chunks.popitem(last=False)
+
+def build_collision(platforms, tile_collision=False):
+    if tile_collision:
+        return TileMap(platforms)
+    return PlatformGrid(platforms)
+
+def follow_camera(level_width, x):
+    # Left edge of the view with x at CAMERA_LEAD, kept inside the level.
+    # Whole pixels, so the static layer never lands between them.
+    return int(max(0, min(x - CAMERA_LEAD, level_width - SCREEN_WIDTH)))
+
+class LevelChunk:
+    # Contents of one CHUNK_WIDTH slice of a streamed level, in level
+    # coordinates: each platform, enemy (x, y, type) and coin (x, y) belongs
+    # to the chunk its x falls in
+    def __init__(self, platforms=(), enemies=(), coins=()):
+        self.platforms = list(platforms)
+        self.enemies = list(enemies)
+        self.coins = list(coins)
+
+WORKERS = {}  # (pid, name) -> executor, so forked processes start their own
+
+def background_worker(name):
+    # The one background thread for name's jobs
+    key = (os.getpid(), name)
+    worker = WORKERS.get(key)
+    if worker is None:
+        worker = WORKERS[key] = ThreadPoolExecutor(1, name)
+    return worker
+
+def chunk_worker():
+    # The background thread preparing chunks ahead of the player
+    return background_worker("chunks")
+
+# Binary level files. Little-endian, every section padded to 4 bytes:
+#   header    LEVEL_HEADER
+#   styles    uint8 (type, r, g, b) per platform style: PLATFORM_TYPES index
+#             and colour, the theme's palette
+#   index     uint32 (platform, enemy, coin) per chunk plus one: where each
+#             chunk's rows start in the three tables below
+#   platforms int32 (x, y, width, height, style), grouped by chunk
+#   enemies   int32 (x, y, ENEMY_TYPES index), grouped by chunk
+#   coins     int32 (x, y), grouped by chunk
+#   solid     uint8 per tile, 1 where a platform covers it
+#   owner     uint16 per tile (uint32 past 65535 platforms), the first
+#             platform covering it
+# The tile grids hold every column of the level, column by column, in the
+# layout TileMap uses. Every platform lies inside its chunk, so the tiles
+# of a run of chunks only name platforms of those chunks. For a boss arena
+# (level 0) the goal is where Bowser Jr. starts.
+LEVEL_MAGIC = b"UM2L"
+LEVEL_VERSION = 1
+LEVEL_HEADER = struct.Struct("<4sBBBBIIHHii3BBIIII")
+PLATFORM_TYPES = ["solid", "brick", "pipe"]
+
+def padded(size):
+    return -(-size // 4) * 4
+
+def write_level_file(path, world_num, level_num, width, platforms, enemies, coins, goal,
+                     sky=SKY_BLUE, tile_size=TILE_SIZE, chunk_width=CHUNK_WIDTH):
+    # enemies are (x, y, type) and coins (x, y); level_num 0 is a boss arena.
+    # Coordinates are rounded to whole pixels and platforms crossing a chunk
+    # edge are split there.
+    chunks = -(-width // chunk_width)
+    rows = -(-SCREEN_HEIGHT // tile_size)
+    cols = -(-width // tile_size)
+    if chunk_width % tile_size:
+        raise ValueError("chunk_width must be a multiple of tile_size")
+
+    def chunk_of(x):
+        return min(chunks - 1, max(0, int(x) // chunk_width))
+
+    styles = {}
+    pieces = []  # (chunk, x, y, width, height, style)
+    for p in platforms:
+        style = styles.setdefault((PLATFORM_TYPES.index(p.type), *p.color), len(styles))
+        x, right = round(p.x), round(p.x + p.width)
+        while True:
+            chunk = chunk_of(x)
+            end = right if chunk == chunks - 1 else min(right, (chunk + 1) * chunk_width)
+            pieces.append((chunk, x, round(p.y), end - x, round(p.height), style))
+            if end >= right:
+                break
+            x = end
+    # Stable sorts keep the original order within each chunk
+    pieces.sort(key=lambda piece: piece[0])
+    enemies = sorted(((chunk_of(x), round(x), round(y), ENEMY_TYPES.index(type))
+                      for x, y, type in enemies), key=lambda e: e[0])
+    coins = sorted(((chunk_of(x), round(x), round(y)) for x, y in coins), key=lambda c: c[0])
+
+    index = np.zeros((chunks + 1, 3), dtype=np.uint32)
+    for column, table in enumerate((pieces, enemies, coins)):
+        counts = np.bincount([row[0] for row in table], minlength=chunks)
+        index[1:, column] = np.cumsum(counts)
+
+    solid = np.zeros((cols, rows), dtype=np.uint8)
+    owner = np.zeros((cols, rows), dtype=np.uint16 if len(pieces) <= 0xFFFF else np.uint32)
+    for i in range(len(pieces) - 1, -1, -1):
+        _, x, y, w, h = pieces[i][:5]
+        x0, x1 = max(0, x // tile_size), min(cols, -(-(x + w) // tile_size))
+        y0, y1 = max(0, y // tile_size), min(rows, -(-(y + h) // tile_size))
+        solid[x0:x1, y0:y1] = 1
+        owner[x0:x1, y0:y1] = i
+
+    sections = [np.array(list(styles), dtype=np.uint8).reshape(-1, 4), index,
+                np.array([piece[1:] for piece in pieces], dtype=np.int32).reshape(-1, 5),
+                np.array([e[1:] for e in enemies], dtype=np.int32).reshape(-1, 3),
+                np.array([c[1:] for c in coins], dtype=np.int32).reshape(-1, 2),
+                solid, owner]
+    with open(path, "wb") as f:
+        f.write(LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, world_num, level_num, tile_size,
+                                  width, chunk_width, rows, len(styles), round(goal[0]),
+                                  round(goal[1]), *sky, owner.itemsize, chunks, len(pieces),
+                                  len(enemies), len(coins)))
+        for section in sections:
+            data = section.tobytes()
+            f.write(data + bytes(padded(len(data)) - len(data)))
+
+class LevelFile:
+    # A level file mapped read-only, as a source for a streamed Level. Its
+    # tables are NumPy views of the mapping and its tile grids go to TileMap
+    # as they are, so opening one costs the same whatever the level's size,
+    # and only the loaded chunks' platforms become Python objects.
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.world_num, self.level_num, self.tile_size, self.width,
+         self.chunk_width, self.rows, styles, self.goal_x, self.goal_y, r, g, b, owner_size,
+         chunks, platforms, enemies, coins) = LEVEL_HEADER.unpack_from(self.map)
+        if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+            raise ValueError(f"{path} is not a version {LEVEL_VERSION} level file")
+        self.sky = (r, g, b)
+        self.cols = -(-self.width // self.tile_size)
+        self.offset = LEVEL_HEADER.size
+        self.styles = self.section(np.uint8, (styles, 4)).tolist()
+        self.index = self.section(np.uint32, (chunks + 1, 3))
+        self.platforms = self.section(np.int32, (platforms, 5))
+        self.enemies = self.section(np.int32, (enemies, 3))
+        self.coins = self.section(np.int32, (coins, 2))
+        tiles = self.cols * self.rows
+        self.solid_offset = self.offset
+        self.offset += padded(tiles)
+        self.owner = memoryview(self.map)[self.offset:self.offset + owner_size * tiles].cast(
+            "H" if owner_size == 2 else "I")
+
+    def section(self, dtype, shape):
+        count = shape[0] * shape[1]
+        array = np.frombuffer(self.map, dtype=dtype, count=count, offset=self.offset)
+        self.offset += padded(array.nbytes)
+        return array.reshape(shape)
+
+    def chunk(self, index):
+        (p0, e0, c0), (p1, e1, c1) = self.index[index:index + 2].tolist()
+        platforms = []
+        for x, y, width, height, style in self.platforms[p0:p1].tolist():
+            type, r, g, b = self.styles[style]
+            platforms.append(Platform(x, y, width, height, (r, g, b), PLATFORM_TYPES[type]))
+        return LevelChunk(platforms,
+                          [(x, y, ENEMY_TYPES[kind]) for x, y, kind in self.enemies[e0:e1].tolist()],
+                          [(x, y) for x, y in self.coins[c0:c1].tolist()])
+
+    def tiles(self, first, end):
+        # TileMap.load() arguments for chunks first to end - 1
+        rows = self.rows
+        left = first * self.chunk_width // self.tile_size
+        right = min(self.cols, end * self.chunk_width // self.tile_size)
+        p0, p1 = self.index[[first, end], 0].tolist()
+        return (left, self.map, self.owner[left * rows:right * rows], self.platforms[p0:p1, :4],
+                self.solid_offset + left * rows, p0)
+
+def level_file_name(world_num, level_num):
+    # level_num None is the boss arena
+    return f"{world_num}-{'B' if level_num is None else level_num}.uml"
+
+# Generated levels. Mario rises about 140px on a jump and carries about
+# 187px at a run before landing at the same height, so these leave margin.
+GENERATOR_VERSION = 1  # Bump whenever generated levels change, retiring cached ones
+LEVEL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ultra-mario-levels")
+MAX_GAP = 140  # Widest generated gap
+MAX_STEP = 100  # Tallest generated pipe
+
+# Per world: ground, brick and sky colours, the chance of a gap after each
+# stretch of ground and of a pipe on it, and the most floating bricks and
+# enemies per chunk
+THEMES = {
+    1: {"name": "grassland", "ground": GROUND_BROWN, "brick": GROUND_BROWN, "sky": SKY_BLUE,
+        "gaps": 0.3, "pipes": 0.5, "bricks": 2, "enemies": 2},
+    2: {"name": "desert", "ground": (222, 184, 135), "brick": (255, 218, 185),
+        "sky": (250, 214, 165), "gaps": 0.2, "pipes": 0.3, "bricks": 1, "enemies": 2},
+    3: {"name": "water", "ground": (0, 90, 150), "brick": (0, 119, 190),
+        "sky": (100, 160, 220), "gaps": 0.6, "pipes": 0.1, "bricks": 3, "enemies": 1},
+    4: {"name": "sky", "ground": WHITE, "brick": WHITE, "sky": (170, 210, 255),
+        "gaps": 0.8, "pipes": 0.0, "bricks": 3, "enemies": 1},
+    5: {"name": "castle", "ground": (80, 80, 80), "brick": (80, 80, 80), "sky": (40, 40, 60),
+        "gaps": 0.4, "pipes": 0.2, "bricks": 2, "enemies": 3},
+}
+
+class ProceduralLevel:
+    # A seeded generated level of any number of screens, as a Level source.
+    # Each chunk is generated on its own from (seed, world, level, index), so
+    # chunks come out the same in any order. Chunks start and end on ground,
+    # gaps are at most MAX_GAP wide and pipes MAX_STEP tall, pipes leave room
+    # to land and take a run-up, and no brick hangs over a pipe or near a
+    # gap to cut a jump short, so there is always a way through. Later
+    # levels in a world have wider gaps and more enemies.
+    def __init__(self, seed, world_num, level_num, screens=20):
+        self.seed = seed
+        self.world_num = world_num
+        self.level_num = level_num
+        self.theme = THEMES[world_num]
+        self.width = screens * CHUNK_WIDTH
+        self.goal_x = self.width - 100
+        self.goal_y = 400
+        self.sky = self.theme["sky"]
+
+    def chunk(self, index):
+        theme = self.theme
+        rng = SimRandom(self.seed << 32 ^ zlib.crc32(struct.pack("<BBI", self.world_num,
+                                                                 self.level_num, index)))
+        left, end = index * CHUNK_WIDTH, (index + 1) * CHUNK_WIDTH
+        # Keep clear of Mario's start in the first chunk and the goal in the last
+        first, last = index == 0, end >= self.width
+        clear_left = left + 300 if first else left
+        clear_right = self.goal_x - 100 if last else end
+        platforms, enemies, coins = [], [], []
+
+        # Ground, in stretches with gaps between
+        ground = []
+        start = x = left
+        while True:
+            x += rng.randint(160, 400)
+            if x > end - 160 or first or last:
+                ground.append((start, end))
+                break
+            if rng.random() < theme["gaps"]:
+                ground.append((start, x))
+                gap = rng.randrange(40, min(MAX_GAP, 60 + 20 * self.level_num) + 1, 10)
+                # A line of coins over the gap
+                for i in (-1, 0, 1):
+                    coins.append((x + gap // 2 - 12 + i * 30, 380 + abs(i) * 20))
+                x += gap
+                start = x
+        for x0, x1 in ground:
+            platforms.append(Platform(x0, 500, x1 - x0, 100, theme["ground"]))
+
+        # Pipes, with room to land and take a run-up on either side
+        pipes = []
+        for x0, x1 in ground:
+            x0, x1 = max(x0 + 200, clear_left), min(x1 - 260, clear_right - 60)
+            if x1 > x0 and rng.random() < theme["pipes"]:
+                x = rng.randrange(x0, x1, 10)
+                height = rng.randrange(40, MAX_STEP + 1, 10)
+                platforms.append(Platform(x, 500 - height, 60, height, PIPE_GREEN, "pipe"))
+                pipes.append(x)
+
+        # Floating bricks high enough to walk under, each with a coin. Never
+        # over a pipe, where Mario couldn't fit between the two, or near a
+        # gap, where bumping into one would drop him in.
+        gaps = [(x1, x0) for (_, x1), (x0, _) in zip(ground, ground[1:])]
+        for _ in range(rng.randint(0, theme["bricks"])):
+            width = rng.randrange(80, 141, 20)
+            x = rng.randrange(left + 20, end - width - 20, 10)
+            if (any(x - 100 < pipe < x + width + 40 for pipe in pipes) or
+                    any(x - 200 < x1 and x0 < x + width + 200 for x0, x1 in gaps)):
+                continue
+            y = rng.randrange(280, 361, 10)
+            platforms.append(Platform(x, y, width, 20, theme["brick"], "brick"))
+            coins.append((x + width // 2 - 12, y - 40))
+
+        # Enemies on the ground
+        for _ in range(rng.randint(0, theme["enemies"] + self.level_num - 1)):
+            x0, x1 = ground[rng.randrange(len(ground))]
+            x0 = max(x0, left + 400 if first else x0)
+            if x1 - x0 >= 80:
+                enemies.append((rng.randrange(x0 + 10, x1 - 42), 450, rng.choice(ENEMY_TYPES)))
+        return LevelChunk(platforms, enemies, coins)
+
+def generated_level(seed, world_num, level_num, screens=20, cache_dir=LEVEL_CACHE_DIR):
+    # The LevelFile of a generated level, generating it into cache_dir the
+    # first time it's asked for
+    name = f"{seed}-{world_num}-{level_num}-{screens}-v{GENERATOR_VERSION}.uml"
+    path = os.path.join(cache_dir, name)
+    if not os.path.exists(path):
+        level = ProceduralLevel(seed, world_num, level_num, screens)
+        chunks = [level.chunk(index) for index in range(screens)]
+        os.makedirs(cache_dir, exist_ok=True)
+        # Renamed into place, in case another process is writing it too
+        temp = f"{path}.{os.getpid()}.tmp"
+        write_level_file(temp, world_num, level_num, level.width,
+                         [p for chunk in chunks for p in chunk.platforms],
+                         [e for chunk in chunks for e in chunk.enemies],
+                         [c for chunk in chunks for c in chunk.coins],
+                         (level.goal_x, level.goal_y), level.sky)
+        os.replace(temp, path)
+    return LevelFile(path)
 
 class Level:
-    def __init__(self, world_num, level_num):
+    # A level comes from generate_level, or is streamed from a source: any
+    # object with width, goal_x and goal_y attributes and a chunk(index)
+    # method returning a LevelChunk, like a LevelFile. Only the chunks around
+    # the view are loaded, the next ones are prepared on the chunk worker, and
+    # chunks left behind are dropped. Enemies and coins outside the loaded
+    # chunks, left behind or walked out, are parked as they are, and come
+    # back when their chunk loads again. chunk() must always return the same
+    # contents, and may be called from the worker. A source may also have a
+    # sky colour, and a tiles(first, end) method giving TileMap.load()
+    # arguments for a run of chunks.
+    def __init__(self, world_num, level_num, tile_collision=False, source=None):
         self.world_num = world_num
         self.level_num = level_num
         self.platforms = []
-        self.enemies = []
-        self.coins = []
-        self.goal_x = SCREEN_WIDTH - 100
+        self.enemies = EnemyStore()
+        self.coins = CoinStore()
+        # Levels may be wider than the screen; the camera scrolls along them
+        self.width = SCREEN_WIDTH
+        self.goal_x = self.width - 100
         self.goal_y = 400
+        self.sky = SKY_BLUE
         self.completed = False
-        self.generate_level()
+        self.source = source
+        self.loaded = None  # Range of chunk indices loaded, when streamed
+        self.chunks = {}  # index -> LevelChunk, loaded or about to be
+        self.pending = {}  # index -> Future of a LevelChunk
+        # index -> (enemies, coins) in EntityStore.rows() form, or None, of
+        # the entities last seen in a chunk that isn't loaded. Read-only and
+        # replaced when it changes, so snapshots share it.
+        self.parked = MappingProxyType({})
+        self.spawned = 0  # Chunks before this have spawned their entities
+        self.layout_version = 0  # Bumped whenever the platforms change
+        if source is None:
+            self.generate_level()
+        else:
+            self.width = source.width
+            self.goal_x, self.goal_y = source.goal_x, source.goal_y
+            self.sky = getattr(source, "sky", SKY_BLUE)
+        self.collision = build_collision(self.platforms, tile_collision)
+        # Coarse grid finding the platforms in view, whatever the collision
+        self.view = PlatformGrid(self.platforms, VIEW_CELL_SIZE)
+        self.static_layer = StaticLayer()
+        if source is not None:
+            self.stream(100)  # Where Mario starts
+
+    def geometry_changed(self):
+        # Call after adding, removing or moving platforms or the goal, or
+        # changing the width
+        self.collision.rebuild()
+        self.view.rebuild()
+        self.static_layer.invalidate()
+        self.layout_version += 1
         
     def generate_level(self):
         # Ground
-        self.platforms.append(Platform(0, 500, SCREEN_WIDTH, 100))
+        self.platforms.append(Platform(0, 500, self.width, 100))
         
         # Generate platforms based on world theme
         if self.world_num == 1:  # Grassland
@@ -365,58 +1557,197 @@ class Level:
             x = 200 + i * 150
             y = 450
             enemy_type = "goomba" if i % 2 == 0 else "koopa"
-            self.enemies.append(Enemy(x, y, enemy_type))
+            self.enemies.add(x, y, enemy_type)
             
         # Add coins
         for platform in self.platforms[1:4]:  # Skip ground
-            self.coins.append(Coin(platform.x + platform.width//2 - 12, platform.y - 40))
+            self.coins.add(platform.x + platform.width//2 - 12, platform.y - 40)
+
+    def chunk(self, index):
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            future = self.pending.pop(index, None)
+            chunk = future.result() if future else self.source.chunk(index)
+            self.chunks[index] = chunk
+        return chunk
+
+    def prefetch(self, index):
+        if 0 <= index < self.chunk_count() and index not in self.chunks and \
+                index not in self.pending:
+            self.pending[index] = chunk_worker().submit(self.source.chunk, index)
+
+    def chunk_count(self):
+        return -(-self.width // CHUNK_WIDTH)
+
+    def stream(self, x):
+        # Load the chunks around the view with Mario at x, drop the rest, and
+        # start preparing the next chunk either way. Depends only on x, so
+        # replays and save states see the same level. Called every tick, so
+        # enemies that walk out of the loaded stretch are parked before they
+        # can fall through the missing ground.
+        camera_x = follow_camera(self.width, x)
+        first = max(0, camera_x // CHUNK_WIDTH - STREAM_BEHIND)
+        end = min(self.chunk_count(),
+                  (camera_x + SCREEN_WIDTH - 1) // CHUNK_WIDTH + 1 + STREAM_AHEAD)
+        if (first, end) == self.loaded:
+            # Coins never move, so only enemies can have left
+            self.park(first, end, coins=False)
+            return
+        old = range(*self.loaded) if self.loaded else range(0)
+        self.load(first, end)
+        # Chunks spawn their entities the first time they load, or are passed
+        for index in range(self.spawned, end):
+            chunk = self.chunk(index)
+            for x, y, type in chunk.enemies:
+                self.enemies.add(x, y, type)
+            for x, y in chunk.coins:
+                self.coins.add(x, y)
+        self.spawned = max(self.spawned, end)
+        self.park(first, end)
+        # Newly loaded chunks take back what was parked with them
+        parked = dict(self.parked)
+        for index in range(first, end):
+            if index not in old and index in parked:
+                for store, rows in zip((self.enemies, self.coins), parked.pop(index)):
+                    if rows is not None:
+                        store.extend(rows)
+        self.parked = MappingProxyType(parked)
+        for index in [i for i in self.chunks if not first - 1 <= i <= end]:
+            del self.chunks[index]
+        for index in [i for i in self.pending if not first - 1 <= i <= end]:
+            self.pending.pop(index).cancel()
+        self.prefetch(end)
+        self.prefetch(first - 1)
+
+    def park(self, first, end, coins=True):
+        # Enemies, and coins if asked, outside chunks first to end - 1 are
+        # parked with the chunk they're in, whether their chunk was dropped or
+        # they walked out, killed and collected ones too. Past either end of
+        # the level counts as the chunk at that end.
+        low = first * CHUNK_WIDTH if first > 0 else -math.inf
+        high = end * CHUNK_WIDTH if end < self.chunk_count() else math.inf
+        parked = None
+        stores = (self.enemies, self.coins) if coins else (self.enemies,)
+        for slot, store in enumerate(stores):
+            n = store.count
+            if n < BULK_UPDATE_MIN:
+                if all(low <= x < high for x in store.x[:n].tolist()):
+                    continue
+            x = store.x[:n]
+            out = (x < low) | (x >= high)
+            if not out.any():
+                continue
+            if parked is None:
+                parked = dict(self.parked)
+            chunk = np.clip(x // CHUNK_WIDTH, 0, self.chunk_count() - 1).astype(int)
+            for index in np.unique(chunk[out]).tolist():
+                rows = list(parked.get(index, (None, None)))
+                rows[slot] = store.rows(chunk == index, rows[slot])
+                parked[index] = tuple(rows)
+            store.compact(~out)
+        if parked is not None:
+            self.parked = MappingProxyType(parked)
+
+    def load(self, first, end):
+        # Platforms of chunks first to end - 1, in order. Chunks never change,
+        # so screens already painted into the static layer stay as they are.
+        self.platforms[:] = [platform for index in range(first, end)
+                             for platform in self.chunk(index).platforms]
+        self.loaded = (first, end)
+        tiles = getattr(self.source, "tiles", None)
+        collision = self.collision
+        if (tiles and isinstance(collision, TileMap) and
+                (collision.tile_size, collision.rows) == (self.source.tile_size, self.source.rows)):
+            # The source's tile grids go in as they are
+            collision.load(*tiles(first, end))
+        else:
+            collision.rebuild()
+        self.view.rebuild()
+        self.layout_version += 1
+
+    def snapshot(self):
+        # Geometry doesn't change in play, so only entities, progress and,
+        # for a streamed level, which chunks are loaded and what's parked
+        return (self.enemies.snapshot(), self.coins.snapshot(), self.completed, self.loaded,
+                self.parked, self.spawned)
+
+    def restore(self, state):
+        enemies, coins, self.completed, loaded, self.parked, self.spawned = state
+        if loaded != self.loaded:
+            self.load(*loaded)
+        self.enemies.restore(enemies)
+        self.coins.restore(coins)
             
     def update(self, mario):
+        if self.source is not None:
+            self.stream(mario.x)
+
         # Update enemies
-        for enemy in self.enemies:
-            enemy.update(self.platforms)
-            # Check collision with Mario
-            if enemy.alive and mario.check_collision(enemy):
-                if mario.vy > 0 and mario.y < enemy.y:
-                    # Stomp enemy
-                    enemy.alive = False
-                    mario.vy = -8
-                else:
-                    # Mario takes damage
-                    mario.power_up = max(0, mario.power_up - 1)
-                    
+        enemies = self.enemies
+        enemies.update(self.collision, self.width)
+        # Check collision with Mario, in order since a stomp changes mario.vy
+        for i in enemies.touching(mario, enemies.alive[:enemies.count]):
+            if mario.vy > 0 and mario.y < enemies.y[i]:
+                # Stomp enemy
+                enemies.alive[i] = False
+                mario.vy = -8
+            else:
+                # Mario takes damage
+                mario.power_up = max(0, mario.power_up - 1)
+
         # Update coins
-        for coin in self.coins:
-            coin.update()
-            if not coin.collected and mario.check_collision(coin):
-                coin.collected = True
-                mario.coins += 1
-                
+        mario.coins += self.coins.update(mario)
+
         # Check goal
         if abs(mario.x - self.goal_x) < 50 and abs(mario.y - self.goal_y) < 50:
             self.completed = True
             
-    def draw(self, screen):
-        for platform in self.platforms:
-            platform.draw(screen)
-        for enemy in self.enemies:
-            enemy.draw(screen)
-        for coin in self.coins:
-            coin.draw(screen)
+    def draw_static(self, screen, camera_x=0):
+        width, height = screen.get_size()
+        for i in self.view.candidates(camera_x, 0, width, height):
+            self.platforms[i].draw(screen, camera_x)
         # Draw goal flag
-        pygame.draw.rect(screen, (139, 90, 43), (self.goal_x, self.goal_y, 10, 100))
+        goal_x = self.goal_x - camera_x
+        pygame.draw.rect(screen, (139, 90, 43), (goal_x, self.goal_y, 10, 100))
         pygame.draw.polygon(screen, (255, 0, 0), 
-                           [(self.goal_x + 10, self.goal_y),
-                            (self.goal_x + 60, self.goal_y + 20),
-                            (self.goal_x + 10, self.goal_y + 40)])
+                           [(goal_x + 10, self.goal_y),
+                            (goal_x + 60, self.goal_y + 20),
+                            (goal_x + 10, self.goal_y + 40)])
+
+    def draw_sprites(self, screen, camera_x=0, alpha=1.0):
+        # Everything that moves, alpha of the way from the previous tick to
+        # the last one; returns the rects drawn
+        return self.enemies.draw(screen, camera_x, alpha) + self.coins.draw(screen, camera_x)
+
+    def draw(self, screen, camera_x=0):
+        self.static_layer.draw(screen, self.draw_static, camera_x)
+        self.draw_sprites(screen, camera_x)
 
 class BossLevel:
-    def __init__(self, world_num):
+    # The arena comes from generate_arena, or from a source as for Level:
+    # its one chunk's platforms, with Bowser Jr. starting at the goal
+    def __init__(self, world_num, tile_collision=False, rng=random, source=None):
         self.world_num = world_num
         self.platforms = []
-        self.boss = BowserJr(SCREEN_WIDTH - 200, 300)
+        self.width = SCREEN_WIDTH  # One screen: the camera never moves
+        self.sky = (64, 0, 0)  # Dark red sky for boss
+        if source is None:
+            self.boss = BowserJr(SCREEN_WIDTH - 200, 300, rng)
+            self.generate_arena()
+        else:
+            self.boss = BowserJr(source.goal_x, source.goal_y, rng)
+            self.platforms += source.chunk(0).platforms
+            self.sky = getattr(source, "sky", self.sky)
         self.completed = False
-        self.generate_arena()
+        self.collision = build_collision(self.platforms, tile_collision)
+        self.static_layer = StaticLayer()
+        self.layout_version = 0  # Bumped whenever the platforms change
+
+    def geometry_changed(self):
+        # Call after adding, removing or moving platforms
+        self.collision.rebuild()
+        self.static_layer.invalidate()
+        self.layout_version += 1
         
     def generate_arena(self):
         # Ground
@@ -426,8 +1757,15 @@ class BossLevel:
         self.platforms.append(Platform(600, 400, 100, 20, BRICK_RED, "brick"))
         self.platforms.append(Platform(350, 350, 100, 20, BRICK_RED, "brick"))
         
+    def snapshot(self):
+        return self.boss.snapshot(), self.completed
+
+    def restore(self, state):
+        boss, self.completed = state
+        self.boss.restore(boss)
+
     def update(self, mario):
-        self.boss.update(mario, self.platforms)
+        self.boss.update(mario, self.collision)
         
         # Check if Mario defeats boss
         if mario.check_collision(self.boss) and mario.vy > 0 and mario.y < self.boss.y:
@@ -437,16 +1775,22 @@ class BossLevel:
                 self.completed = True
                 
         # Check fireball collisions
-        for fireball in self.boss.fireballs:
-            if (abs(fireball.x - mario.x - mario.width//2) < 20 and
-                abs(fireball.y - mario.y - mario.height//2) < 20):
-                mario.power_up = max(0, mario.power_up - 1)
-                self.boss.fireballs.remove(fireball)
+        hits = self.boss.fireballs.hits(mario.x + mario.width//2, mario.y + mario.height//2, 20)
+        if len(hits):
+            mario.power_up = max(0, mario.power_up - len(hits))
+            self.boss.fireballs.kill(hits)
                 
-    def draw(self, screen):
+    def draw_static(self, screen, camera_x=0):
         for platform in self.platforms:
-            platform.draw(screen)
-        self.boss.draw(screen)
+            platform.draw(screen, camera_x)
+
+    def draw_sprites(self, screen, camera_x=0, alpha=1.0):
+        # camera_x is always 0 in the arena
+        return self.boss.draw(screen, alpha)
+
+    def draw(self, screen, camera_x=0):
+        self.static_layer.draw(screen, self.draw_static, camera_x)
+        self.draw_sprites(screen, camera_x)
 
 class Overworld:
     def __init__(self):
@@ -459,8 +1803,19 @@ class Overworld:
         ]
         self.current_world = 0
         self.completed_levels = [[False] * 4 for _ in range(5)]  # 3 levels + boss
+
+    def snapshot(self):
+        return self.current_world, [row[:] for row in self.completed_levels]
+
+    def restore(self, state):
+        self.current_world, completed = state
+        self.completed_levels = [row[:] for row in completed]
         
     def draw(self, screen, mario_sprite_x=0, mario_sprite_y=0):
+        self.draw_map(screen)
+        self.draw_marker(screen, mario_sprite_x, mario_sprite_y)
+
+    def draw_map(self, screen):
         # Draw SMB3-style overworld paths
         for i in range(len(self.world_positions) - 1):
             x1, y1 = self.world_positions[i]
@@ -481,8 +1836,7 @@ class Overworld:
             pygame.draw.circle(screen, BLACK, (x, y), 30, 3)
             
             # World number
-            font = pygame.font.Font(None, 24)
-            text = font.render(str(i + 1), True, BLACK)
+            text = TEXT.render(str(i + 1), SMALL_FONT_SIZE, BLACK)
             screen.blit(text, (x - 8, y - 10))
             
             # Level indicators
@@ -494,319 +1848,1348 @@ class Overworld:
                 else:
                     pygame.draw.rect(screen, (255, 0, 0), (lx, ly, 15, 15))
                 pygame.draw.rect(screen, BLACK, (lx, ly, 15, 15), 1)
-                
+
+    def draw_marker(self, screen, mario_sprite_x=0, mario_sprite_y=0):
         # Draw mini Mario on current world
         wx, wy = self.world_positions[self.current_world]
-        pygame.draw.rect(screen, MARIO_RED, (wx - 8 + mario_sprite_x, wy - 40 + mario_sprite_y, 16, 24))
+        return pygame.draw.rect(screen, MARIO_RED, (wx - 8 + mario_sprite_x, wy - 40 + mario_sprite_y, 16, 24))
 
-class Game:
-    def __init__(self):
-        self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-        pygame.display.set_caption("Ultra Mario 2D Bros - BS Satellaview Edition")
-        self.clock = pygame.time.Clock()
+class SimRandom(random.Random):
+    # random.Random over SplitMix64, whose whole state is one 64-bit integer.
+    # Saving and restoring it is as cheap as copying an int, where the
+    # Mersenne Twister's 625-word state costs more to snapshot than the rest
+    # of the simulation put together.
+    MASK = (1 << 64) - 1
+
+    def seed(self, a=None):
+        if a is None:
+            a = int.from_bytes(os.urandom(8), "little")
+        elif not isinstance(a, int):
+            a = hash(a)
+        self.state = a & self.MASK
+
+    def next64(self):
+        self.state = z = (self.state + 0x9E3779B97F4A7C15) & self.MASK
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & self.MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & self.MASK
+        return z ^ (z >> 31)
+
+    def random(self):
+        return (self.next64() >> 11) * (1.0 / (1 << 53))
+
+    def getrandbits(self, k):
+        bits = 0
+        for shift in range(0, k, 64):
+            bits |= self.next64() << shift
+        return bits & ((1 << k) - 1)
+
+    def getstate(self):
+        return self.state
+
+    def setstate(self, state):
+        self.state = state
+
+class Inputs:
+    # One tick of player input: keys pressed this tick (KEYDOWN codes) plus
+    # the held left/right state read from pygame.key.get_pressed()
+    __slots__ = ("pressed", "left", "right")
+
+    def __init__(self, pressed=(), left=False, right=False):
+        self.pressed = tuple(pressed)
+        self.left = left
+        self.right = right
+
+# Replay header: magic, version, flags (1 = fixed-point, 2 = tile collision,
+# 4 = stages from a level directory, 8 = generated levels), seed, and the
+# generator's seed and screens
+REPLAY_HEADER = struct.Struct("<4sBBqqI")
+
+class ReplayWriter:
+    # Streams one Inputs per tick to a replay file. Ticks are run-length
+    # coded: a run of ticks sharing the held left/right state, the first of
+    # which may carry key presses, is one varint
+    # (run << 3 | has presses << 2 | right << 1 | left), then the presses as
+    # a varint count and varint keycodes. Idle play costs a byte or two per
+    # state change, so an hour of input is tens of kilobytes. level_dir and
+    # generate are the Simulation's; only whether a level directory was used
+    # is recorded, not its path.
+    def __init__(self, path, seed, fixed_point=False, tile_collision=False, level_dir=None,
+                 generate=None):
+        self.file = open(path, "wb")
+        flags = ((1 if fixed_point else 0) | (2 if tile_collision else 0) |
+                 (4 if level_dir is not None else 0) | (8 if generate is not None else 0))
+        generate_seed, screens = generate or (0, 0)
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, flags, seed,
+                                           generate_seed, screens))
+        self.held = (False, False)
+        self.pressed = ()
+        self.run = 0
+
+    def record(self, inputs):
+        held = (bool(inputs.left), bool(inputs.right))
+        if inputs.pressed or held != self.held:
+            self.end_run()
+            self.held = held
+            self.pressed = inputs.pressed
+        self.run += 1
+
+    def end_run(self):
+        if not self.run:
+            return
+        left, right = self.held
+        out = bytearray()
+        write_varint(out, self.run << 3 | bool(self.pressed) << 2 | right << 1 | left)
+        if self.pressed:
+            write_varint(out, len(self.pressed))
+            for key in self.pressed:
+                write_varint(out, key)
+        self.file.write(out)
+        self.run = 0
+
+    def close(self):
+        self.end_run()
+        self.file.close()
+
+class ReplayReader:
+    # Reads a ReplayWriter file; iterating yields one Inputs per tick
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        magic, version = struct.unpack_from("<4sB", self.data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"{path} is not a version {REPLAY_VERSION} replay")
+        magic, version, flags, self.seed, generate_seed, screens = \
+            REPLAY_HEADER.unpack_from(self.data)
+        self.fixed_point = bool(flags & 1)
+        self.tile_collision = bool(flags & 2)
+        self.level_dir = bool(flags & 4)
+        self.generate = (generate_seed, screens) if flags & 8 else None
+
+    def levels(self, level_dir=None, generate=None):
+        # The generate argument for a Simulation replaying the run, given the
+        # level options asked for: generated levels come from the header, and
+        # a level directory must be given again. Raises ValueError if they
+        # don't match the recording, which would play differently.
+        if generate is not None and generate != self.generate:
+            raise ValueError(f"replay was recorded with generate={self.generate}, "
+                             f"not {generate}")
+        if (level_dir is not None) != self.level_dir:
+            if self.level_dir:
+                raise ValueError("replay was recorded with stages from a level directory; "
+                                 "give the same one")
+            raise ValueError("replay was recorded without a level directory")
+        return self.generate
+
+    def __iter__(self):
+        data = self.data
+        pos = REPLAY_HEADER.size
+        while pos < len(data):
+            code, pos = read_varint(data, pos)
+            pressed = []
+            if code & 4:
+                count, pos = read_varint(data, pos)
+                for _ in range(count):
+                    key, pos = read_varint(data, pos)
+                    pressed.append(key)
+            left, right = bool(code & 1), bool(code & 2)
+            yield Inputs(pressed, left, right)
+            idle = Inputs((), left, right)
+            for _ in range((code >> 3) - 1):
+                yield idle
+
+def write_varint(out, value):
+    # LEB128: seven bits per byte, low bits first
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def play_replay(path, level_dir=None, generate=None):
+    # Replays a recording headless at full simulation speed; returns the
+    # Simulation as the recorded run left it. level_dir must be the one the
+    # run was recorded with; generate is taken from the recording, and
+    # checked against it if given.
+    replay = ReplayReader(path)
+    generate = replay.levels(level_dir, generate)
+    use_fixed_point(replay.fixed_point)
+    sim = Simulation(replay.tile_collision, replay.seed, level_dir, generate)
+    for inputs in replay:
+        if not sim.step(inputs):
+            break
+    return sim
+
+class LevelCache:
+    # Stages built once and handed out again as good as new: each is kept
+    # with the snapshot it had when built, and restoring that is far cheaper
+    # than generating, streaming and repainting it again. prefetch() builds
+    # stages ahead on a background thread, so entering them doesn't stall.
+    # There is one instance per stage, so only one can be in play at a time.
+    def __init__(self, build):
+        self.build = build  # (world_num, level_num) -> a new Level or BossLevel
+        self.stages = {}  # (world_num, level_num) -> (stage, snapshot when built)
+        self.pending = {}  # (world_num, level_num) -> Future of the same
+
+    def get(self, world_num, level_num):
+        key = (world_num, level_num)
+        entry = self.stages.get(key)
+        if entry is None:
+            future = self.pending.pop(key, None)
+            entry = self.stages[key] = future.result() if future else self.built(key)
+        stage, start = entry
+        stage.restore(start)
+        return stage
+
+    def built(self, key):
+        stage = self.build(*key)
+        return stage, stage.snapshot()
+
+    def prefetch(self, keys):
+        for key in keys:
+            if key not in self.stages and key not in self.pending:
+                self.pending[key] = background_worker("levels").submit(self.built, key)
+
+class Simulation:
+    # All game state and rules, stepped one tick at a time with no display.
+    # Game.run is a front-end that feeds it input and draws the result.
+    # All of its randomness comes from self.rng, so with a seed the same
+    # inputs always give the same run.
+    def __init__(self, tile_collision=False, seed=None, level_dir=None, generate=None):
+        self.tile_collision = tile_collision
+        self.seed = seed
+        # Stages with a level file here are loaded from it instead of built
+        self.level_dir = level_dir
+        # (seed, screens) to play generated levels instead of the built-in ones
+        self.generate = generate
+        # Stages are built once and reused, so they and the rng they hold
+        # outlive reset()
+        self.rng = SimRandom(seed)
+        self.levels = LevelCache(self.build_stage)
+        self.reset()
+
+    def reset(self):
         self.state = GameState.BS_MENU
         self.mario = Mario(100, 400)
         self.overworld = Overworld()
         self.current_level = None
         self.current_boss = None
-        self.font = pygame.font.Font(None, 36)
-        self.small_font = pygame.font.Font(None, 24)
         self.bs_menu_selection = 0
+        self.running = True
+        self.ticks = 0
+        self.deaths = 0  # Lives lost, since Mario respawns as the same object
+        self.rng.seed(self.seed)
+
+    def snapshot(self):
+        # Save state in microseconds: current objects are kept by reference
+        # alongside copies of their mutable state, so restoring never
+        # regenerates a level and a snapshot can be restored any number of times
+        level, boss = self.current_level, self.current_boss
+        return (self.state, self.bs_menu_selection, self.running, self.ticks, self.deaths,
+                self.rng.getstate(), self.mario, self.mario.snapshot(),
+                self.overworld.snapshot(),
+                level, level.snapshot() if level else None,
+                boss, boss.snapshot() if boss else None)
+
+    def restore(self, state):
+        (self.state, self.bs_menu_selection, self.running, self.ticks, self.deaths, rng,
+         self.mario, mario, overworld,
+         self.current_level, level, self.current_boss, boss) = state
+        self.rng.setstate(rng)
+        self.mario.restore(mario)
+        self.overworld.restore(overworld)
+        if self.current_level:
+            self.current_level.restore(level)
+        if self.current_boss:
+            self.current_boss.restore(boss)
+
+    def level_file(self, world_num, level_num):
+        # LevelFile for a stage from level_dir or the generator, or None
+        if self.level_dir is not None:
+            path = os.path.join(self.level_dir, level_file_name(world_num, level_num))
+            if os.path.exists(path):
+                return LevelFile(path)
+        if self.generate is not None and level_num is not None:
+            seed, screens = self.generate
+            return generated_level(seed, world_num, level_num, screens)
+        return None
+
+    def build_stage(self, world_num, level_num):
+        # A new Level, or BossLevel for level_num None, from the stage's
+        # level file if it has one. May run on the levels worker.
+        source = self.level_file(world_num, level_num)
+        if level_num is None:
+            return BossLevel(world_num, self.tile_collision, self.rng, source)
+        return Level(world_num, level_num, self.tile_collision, source)
+
+    def next_stages(self):
+        # The stages the overworld lets the player enter next
+        world = self.overworld.current_world
+        completed = self.overworld.completed_levels[world]
+        stages = [(world + 1, 1)]
+        stages += [(world + 1, level) for level in (2, 3) if completed[level - 2]]
+        if completed[2]:
+            stages.append((world + 1, None))
+        return stages
+
+    def start_level(self, world_num, level_num, source=None):
+        # A given source is built from fresh, other stages come from the cache
+        if source is None:
+            self.current_level = self.levels.get(world_num, level_num)
+        else:
+            self.current_level = Level(world_num, level_num, self.tile_collision, source)
+        self.state = GameState.LEVEL
+        self.mario.respawn(100, 400)
+
+    def start_boss(self, world_num, source=None):
+        if source is None:
+            self.current_boss = self.levels.get(world_num, None)
+        else:
+            self.current_boss = BossLevel(world_num, self.tile_collision, self.rng, source)
+        self.state = GameState.BOSS
+        self.mario.respawn(100, 400)
+
+    def handle_key(self, key):
+        if self.state == GameState.BS_MENU:
+            if key == pygame.K_UP:
+                self.bs_menu_selection = (self.bs_menu_selection - 1) % 4
+            elif key == pygame.K_DOWN:
+                self.bs_menu_selection = (self.bs_menu_selection + 1) % 4
+            elif key == pygame.K_RETURN:
+                if self.bs_menu_selection == 0:  # Start Game
+                    self.state = GameState.OVERWORLD
+                elif self.bs_menu_selection == 3:  # Exit
+                    self.running = False
+            # Press 'q' to directly load a level from the menu
+            elif key == pygame.K_q:
+                self.start_level(1, 1)
+
+        elif self.state == GameState.OVERWORLD:
+            world = self.overworld.current_world
+            completed = self.overworld.completed_levels[world]
+            if key == pygame.K_LEFT and world > 0:
+                # Check if previous world is completed
+                if self.overworld.completed_levels[world - 1][3]:
+                    self.overworld.current_world -= 1
+            elif key == pygame.K_RIGHT and world < 4:
+                # Check if current world boss is defeated
+                if completed[3]:
+                    self.overworld.current_world += 1
+            elif key == pygame.K_1:  # Level 1
+                self.start_level(world + 1, 1)
+            elif key == pygame.K_2:  # Level 2
+                if completed[0]:
+                    self.start_level(world + 1, 2)
+            elif key == pygame.K_3:  # Level 3
+                if completed[1]:
+                    self.start_level(world + 1, 3)
+            elif key == pygame.K_b:  # Boss
+                if completed[2]:
+                    self.start_boss(world + 1)
+            elif key == pygame.K_ESCAPE:
+                self.state = GameState.BS_MENU
+            # Press 'q' to directly load a level from overworld
+            elif key == pygame.K_q:
+                self.start_level(world + 1, 1)
+
+        elif self.state in [GameState.LEVEL, GameState.BOSS]:
+            if key == pygame.K_SPACE or key == pygame.K_UP:
+                self.mario.jump()
+            elif key == pygame.K_ESCAPE:
+                self.state = GameState.OVERWORLD
+            # Press 'q' to load a new level while in a level
+            elif key == pygame.K_q:
+                if self.current_level:
+                    next_level = (self.current_level.level_num % 3) + 1
+                    self.start_level(self.current_level.world_num, next_level)
+                else:
+                    self.start_level(1, 1)
+
+        elif self.state == GameState.GAME_OVER:
+            if key == pygame.K_RETURN:
+                self.reset()
+            # Press 'q' to load a level from game over screen
+            elif key == pygame.K_q:
+                self.start_level(1, 1)
+
+        elif self.state == GameState.VICTORY:
+            if key == pygame.K_RETURN:
+                self.state = GameState.BS_MENU
+            # Press 'q' to load a level from victory screen
+            elif key == pygame.K_q:
+                self.start_level(1, 1)
+
+    def step(self, inputs):
+        for key in inputs.pressed:
+            self.handle_key(key)
+
+        # Continuous key input for movement
+        if self.state in [GameState.LEVEL, GameState.BOSS]:
+            if inputs.left:
+                self.mario.move_left()
+            elif inputs.right:
+                self.mario.move_right()
+            else:
+                self.mario.stop()
+
+        # Update game logic
+        if self.state == GameState.LEVEL:
+            if self.current_level:
+                if not self.mario.update(self.current_level.collision, self.current_level.width):
+                    if self.mario.lives <= 0:
+                        self.state = GameState.GAME_OVER
+                    else:
+                        self.deaths += 1
+                        self.mario.respawn(100, 400)
+
+                self.current_level.update(self.mario)
+
+                if self.current_level.completed:
+                    # Mark level as completed
+                    level_index = self.current_level.level_num - 1
+                    self.overworld.completed_levels[self.overworld.current_world][level_index] = True
+                    # Unlock next level
+                    if level_index < 2:
+                        self.overworld.completed_levels[self.overworld.current_world][level_index + 1] = True
+                    self.state = GameState.OVERWORLD
+
+        elif self.state == GameState.BOSS:
+            if self.current_boss:
+                if not self.mario.update(self.current_boss.collision, self.current_boss.width):
+                    if self.mario.lives <= 0:
+                        self.state = GameState.GAME_OVER
+                    else:
+                        self.deaths += 1
+                        self.mario.respawn(100, 400)
+
+                self.current_boss.update(self.mario)
+
+                if self.current_boss.completed:
+                    # Mark boss as defeated
+                    self.overworld.completed_levels[self.overworld.current_world][3] = True
+                    # Check if all worlds completed
+                    if self.overworld.current_world == 4:
+                        self.state = GameState.VICTORY
+                    else:
+                        # Unlock next world
+                        if self.overworld.current_world < 4:
+                            self.overworld.current_world += 1
+                        self.state = GameState.OVERWORLD
+
+        if self.state == GameState.OVERWORLD:
+            self.levels.prefetch(self.next_stages())
+
+        self.ticks += 1
+        return self.running
+
+def snapshot_ref(index):
+    # Stands in for an object a pickled snapshot keeps by reference;
+    # SnapshotUnpickler swaps in its own lookup
+    raise pickle.UnpicklingError("snapshot references need a SnapshotUnpickler")
+
+class SnapshotPickler(pickle.Pickler):
+    # Pickles a snapshot leaving out the objects it keeps by reference,
+    # which are appended to refs in order. reducer_override is never asked
+    # about plain values, so they pickle at full speed.
+    by_reference = (Mario, Level, BossLevel, MappingProxyType)
+
+    def __init__(self, file, refs):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.refs = refs
+
+    def reducer_override(self, obj):
+        if isinstance(obj, self.by_reference):
+            self.refs.append(obj)
+            return snapshot_ref, (len(self.refs) - 1,)
+        return NotImplemented
+
+class SnapshotUnpickler(pickle.Unpickler):
+    def __init__(self, file, refs):
+        super().__init__(file)
+        self.refs = refs
+
+    def find_class(self, module, name):
+        if (module, name) == (snapshot_ref.__module__, snapshot_ref.__name__):
+            return self.refs.__getitem__
+        return super().find_class(module, name)
+
+class RewindBuffer:
+    # Ring buffer of the last few seconds of Simulation snapshots. Every
+    # REWIND_KEYFRAME_INTERVAL ticks the pickled snapshot is kept whole as a
+    # keyframe; the ticks in between store it XORed against their keyframe,
+    # which is almost all zero bytes, zlib-compressed. A tick whose pickle
+    # changes length (an enemy count, a state switch) starts a new keyframe.
+    # The game objects a Simulation snapshot holds, and read-only mappings
+    # like a level's parked entities, are kept by reference rather than
+    # pickled.
+    def __init__(self, seconds=REWIND_SECONDS):
+        self.entries = deque(maxlen=seconds * FPS)
+        self.keyframe = None  # (raw bytes as uint8 array, compressed bytes)
+        self.since_keyframe = 0
+        self.decoded = (None, None)  # Last keyframe decompressed for pop()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, snapshot):
+        refs = []
+        file = io.BytesIO()
+        SnapshotPickler(file, refs).dump(snapshot)
+        data = np.frombuffer(file.getvalue(), dtype=np.uint8)
+        keyframe = self.keyframe
+        if (keyframe is None or self.since_keyframe >= REWIND_KEYFRAME_INTERVAL or
+                len(data) != len(keyframe[0])):
+            keyframe = self.keyframe = (data.copy(), zlib.compress(data, 1))
+            self.since_keyframe = 0
+            delta = None
+        else:
+            delta = zlib.compress(data ^ keyframe[0], 1)
+        self.since_keyframe += 1
+        self.entries.append((keyframe[1], delta, refs))
+
+    def pop(self):
+        # The most recent snapshot, removed from the buffer, or None if empty
+        if not self.entries:
+            return None
+        key, delta, refs = self.entries.pop()
+        if self.decoded[0] is not key:
+            self.decoded = (key, np.frombuffer(zlib.decompress(key), dtype=np.uint8))
+        data = self.decoded[1]
+        if delta is not None:
+            data = data ^ np.frombuffer(zlib.decompress(delta), dtype=np.uint8)
+        # Pushing resumes from a fresh keyframe
+        self.keyframe = None
+        return SnapshotUnpickler(io.BytesIO(data.tobytes()), refs).load()
+
+    def nbytes(self):
+        # Compressed size of the history held, counting shared keyframes once
+        keys = {id(key): len(key) for key, _, _ in self.entries}
+        return sum(keys.values()) + sum(len(delta) for _, delta, _ in self.entries if delta)
+
+def rasterize_boxes(plane, x, y, w, h, out, sx, sy, left=0):
+    # Sets to 255 the cells of out (planes, rows, cols) that box i, given in
+    # screen pixels, covers in plane[i]. Column 0 of out is cell column
+    # left. The boxes are expanded to their cell indices with repeat/arange
+    # and written in one scatter, so the cost is the cells covered rather
+    # than the size of the grid.
+    planes, rows, cols = out.shape
+    x0 = np.clip(np.floor(x * sx) - left, 0, cols).astype(np.intp)
+    x1 = np.clip(np.ceil((x + w) * sx) - left, 0, cols).astype(np.intp)
+    y0 = np.clip(np.floor(y * sy), 0, rows).astype(np.intp)
+    y1 = np.clip(np.ceil((y + h) * sy), 0, rows).astype(np.intp)
+    width = np.maximum(x1 - x0, 0)
+    cells = width * np.maximum(y1 - y0, 0)
+    box = np.repeat(np.arange(len(cells)), cells)
+    k = np.arange(len(box)) - np.repeat(np.cumsum(cells) - cells, cells)
+    row = y0[box] + k // width[box]
+    col = x0[box] + k % width[box]
+    out.reshape(-1)[(plane[box] * rows + row) * cols + col] = 255
+
+class Rasterizer:
+    # Paints simulation state straight into small uint8 grids, one channel
+    # per kind of object (255 where it covers a cell), with NumPy alone: no
+    # pygame drawing, surface or display. A batch of simulations is painted
+    # in one rasterize_boxes call; platforms are painted once per level (or
+    # per load, for a streamed one) across the stretch they span, and each
+    # frame copies the columns under the camera.
+    channels = ("platform", "mario", "enemy", "coin", "hazard")
+
+    def __init__(self, width=84, height=84):
+        self.width = width
+        self.height = height
+        self.sx = width / SCREEN_WIDTH
+        self.sy = height / SCREEN_HEIGHT
+        # level -> (version, first column, grid)
+        self.platform_grids = weakref.WeakKeyDictionary()
+
+    def platforms(self, level):
+        # (first column, grid) of the level's platforms
+        version, left, grid = self.platform_grids.get(level, (None, 0, None))
+        if version != level.layout_version:
+            p = level.platforms
+            version = level.layout_version
+            x = np.array([q.x for q in p], dtype=float)
+            right = np.array([q.x + q.width for q in p], dtype=float)
+            left = max(0, int(x.min() * self.sx)) if len(p) else 0
+            cols = max(self.width, math.ceil(right.max(initial=SCREEN_WIDTH) * self.sx)) - left
+            grid = np.zeros((1, self.height, cols), dtype=np.uint8)
+            rasterize_boxes(np.zeros(len(p), dtype=np.intp),
+                            x,
+                            np.array([q.y for q in p], dtype=float),
+                            np.array([q.width for q in p], dtype=float),
+                            np.array([q.height for q in p], dtype=float),
+                            grid, self.sx, self.sy, left)
+            grid = grid[0]
+            self.platform_grids[level] = (version, left, grid)
+        return left, grid
+
+    def render(self, sims, out=None):
+        # Returns out, shaped (len(sims), len(channels), height, width) and
+        # C-contiguous
+        count = len(sims)
+        if out is None:
+            out = np.empty((count, len(self.channels), self.height, self.width), dtype=np.uint8)
+        out[:, 1:] = 0
+        boxes = []  # (channel, x, y, w, h) arrays per simulation
+        for i, sim in enumerate(sims):
+            level = sim.current_boss if sim.state == GameState.BOSS else sim.current_level
+            if sim.state not in (GameState.LEVEL, GameState.BOSS) or level is None:
+                out[i, 0] = 0
+                continue
+            mario = sim.mario
+            # The camera, snapped to whole cells
+            col = int(follow_camera(level.width, mario.x) * self.sx)
+            camera_x = col / self.sx
+            left, grid = self.platforms(level)
+            # Columns of the view the loaded platforms span, if any: a
+            # streamed level's may not reach it
+            start = max(col, left)
+            end = max(start, min(col + self.width, left + grid.shape[1]))
+            if start > col or end < col + self.width:
+                out[i, 0] = 0
+            if end > start:
+                out[i, 0, :, start - col:end - col] = grid[:, start - left:end - left]
+            boxes.append((i, 0, [mario.x - camera_x], [mario.y], mario.width, mario.height))
+            if sim.state == GameState.LEVEL:
+                enemies, coins = level.enemies, level.coins
+                shown = enemies.visible(enemies.alive[:enemies.count], camera_x,
+                                        camera_x + SCREEN_WIDTH)
+                boxes.append((i, 1, enemies.x[shown] - camera_x, enemies.y[shown],
+                              Enemy.width, Enemy.height))
+                shown = coins.visible(~coins.collected[:coins.count], camera_x,
+                                      camera_x + SCREEN_WIDTH)
+                boxes.append((i, 2, coins.x[shown] - camera_x, coins.y[shown],
+                              Coin.width, Coin.height))
+            else:
+                boss, pool, r = level.boss, level.boss.fireballs, Fireball.radius
+                boxes.append((i, 3, [boss.x], [boss.y], boss.width, boss.height))
+                boxes.append((i, 3, pool.x[pool.active] - r, pool.y[pool.active] - r,
+                              2 * r, 2 * r))
+        if not boxes:
+            return out
+        planes = len(self.channels)
+        sizes = [len(x) for _, _, x, _, _, _ in boxes]
+        plane = np.repeat([i * planes + c + 1 for i, c, _, _, _, _ in boxes], sizes)
+        rasterize_boxes(plane.astype(np.intp),
+                        np.concatenate([b[2] for b in boxes]).astype(float),
+                        np.concatenate([b[3] for b in boxes]).astype(float),
+                        np.repeat([float(b[4]) for b in boxes], sizes),
+                        np.repeat([float(b[5]) for b in boxes], sizes),
+                        out.reshape(count * planes, self.height, self.width),
+                        self.sx, self.sy)
+        return out
+
+# Environment actions as (left, right, jump)
+ACTIONS = [
+    (False, False, False),
+    (True, False, False),
+    (False, True, False),
+    (False, False, True),
+    (True, False, True),
+    (False, True, True),
+]
+
+class MarioEnv:
+    # Gym-style environment over one level (level_num 1-3) or boss fight
+    # (level_num None) of a world. Episodes end when the level is completed
+    # or Mario loses a life, and are truncated after max_ticks. Observations
+    # are float32 vectors of OBS_SIZE, positions relative to Mario and scaled
+    # by the screen size: Mario (x, y, vx, vy, on ground, power-up), the goal
+    # or boss offset, then (dx, dy, 1) for the nearest OBS_ENEMIES live
+    # enemies and OBS_COINS coins left, (dx, dy, hp) for the boss and
+    # (dx, dy) for the nearest OBS_FIREBALLS fireballs, each nearest first
+    # and zero-padded.
+    rewards = {"coin": 1.0, "complete": 10.0, "boss_hit": 3.0, "death": -5.0}
+
+    def __init__(self, world_num=1, level_num=1, seed=None, max_ticks=60 * FPS, frame_skip=1):
+        self.sim = Simulation(seed=seed)
+        if level_num is None:
+            self.sim.start_boss(world_num)
+        else:
+            self.sim.start_level(world_num, level_num)
+        self.max_ticks = max_ticks
+        self.frame_skip = frame_skip
+        # Resetting restores this instead of regenerating the level
+        self.start = self.sim.snapshot()
+        self.episode_ticks = 0
+
+    def reset(self, seed=None):
+        obs = np.zeros(OBS_SIZE, dtype=np.float32)
+        self.reset_into(obs, seed)
+        return obs, {}
+
+    def step(self, action):
+        obs = np.zeros(OBS_SIZE, dtype=np.float32)
+        reward, terminated, truncated = self.step_into(action, obs)
+        return obs, reward, terminated, truncated, {}
+
+    def reset_into(self, obs, seed=None):
+        # The start state holds the rng too; keep it running on from the last
+        # episode, or every episode would see the same random numbers
+        rng = self.sim.rng
+        state = rng.getstate()
+        self.sim.restore(self.start)
+        if seed is None:
+            rng.setstate(state)
+        else:
+            rng.seed(seed)
+        self.episode_ticks = 0
+        self.observe(obs)
+
+    def step_into(self, action, obs):
+        # step() writing the observation into obs; returns
+        # (reward, terminated, truncated)
+        sim = self.sim
+        left, right, jump = ACTIONS[action]
+        inputs = Inputs((pygame.K_SPACE,) if jump else (), left, right)
+        reward = 0.0
+        terminated = False
+        for _ in range(self.frame_skip):
+            deaths, boss = sim.deaths, sim.current_boss
+            coins = sim.mario.coins
+            hp = boss.boss.hp if boss else 0
+            sim.step(inputs)
+            self.episode_ticks += 1
+            reward += (sim.mario.coins - coins) * self.rewards["coin"]
+            if boss:
+                reward += (hp - boss.boss.hp) * self.rewards["boss_hit"]
+            if sim.deaths != deaths or sim.state == GameState.GAME_OVER:
+                reward += self.rewards["death"]
+                terminated = True
+                break
+            if sim.state not in (GameState.LEVEL, GameState.BOSS):
+                reward += self.rewards["complete"]
+                terminated = True
+                break
+        self.observe(obs)
+        truncated = not terminated and self.episode_ticks >= self.max_ticks
+        return reward, terminated, truncated
+
+    def observe(self, obs):
+        sim = self.sim
+        mario = sim.mario
+        mx, my = mario.x, mario.y
+        obs[:] = 0
+        obs[:6] = (mx / SCREEN_WIDTH, my / SCREEN_HEIGHT, mario.vx / MOVE_SPEED,
+                   mario.vy / -JUMP_STRENGTH, mario.on_ground, mario.power_up / 2)
+        i = 8
+        level = sim.current_level
+        if level:
+            obs[6:8] = ((level.goal_x - mx) / SCREEN_WIDTH, (level.goal_y - my) / SCREEN_HEIGHT)
+            enemies, coins = level.enemies, level.coins
+            i = self.observe_store(obs, i, enemies, enemies.alive[:enemies.count], OBS_ENEMIES,
+                                   mx, my)
+            i = self.observe_store(obs, i, coins, ~coins.collected[:coins.count], OBS_COINS,
+                                   mx, my)
+        boss_level = sim.current_boss
+        if boss_level:
+            boss = boss_level.boss
+            i = 8 + 3 * (OBS_ENEMIES + OBS_COINS)
+            obs[6:8] = obs[i:i + 2] = ((boss.x - mx) / SCREEN_WIDTH, (boss.y - my) / SCREEN_HEIGHT)
+            obs[i + 2] = boss.hp / 3
+            i += 3
+            pool = boss.fireballs
+            dx, dy = self.nearest(pool.x, pool.y, pool.active, OBS_FIREBALLS, mx, my)
+            n = len(dx)
+            obs[i:i + 2 * n:2] = dx
+            obs[i + 1:i + 2 * n:2] = dy
+
+    @staticmethod
+    def nearest(x, y, live, count, mx, my):
+        # Screen-scaled offsets from Mario of the count entities under live
+        # nearest to him, nearest first, as lists
+        if len(live) < BULK_UPDATE_MIN:
+            # A handful is cheaper to sort in Python than NumPy
+            near = []
+            for k, (px, py, alive) in enumerate(zip(x.tolist(), y.tolist(), live.tolist())):
+                if alive:
+                    dx, dy = px - mx, py - my
+                    near.append((dx * dx + dy * dy, k, dx, dy))
+            near = sorted(near)[:count]
+            return ([dx / SCREEN_WIDTH for _, _, dx, _ in near],
+                    [dy / SCREEN_HEIGHT for _, _, _, dy in near])
+        index = np.flatnonzero(live)
+        dx, dy = x[index] - mx, y[index] - my
+        order = np.argsort(dx * dx + dy * dy, kind="stable")[:count]
+        return (dx[order] / SCREEN_WIDTH).tolist(), (dy[order] / SCREEN_HEIGHT).tolist()
+
+    @staticmethod
+    def observe_store(obs, i, store, live, count, mx, my):
+        # Writes (dx, dy, 1) for the count entities under live nearest Mario
+        # at obs[i]
+        dx, dy = MarioEnv.nearest(store.x[:store.count], store.y[:store.count], live, count,
+                                  mx, my)
+        n = len(dx)
+        obs[i:i + 3 * n:3] = dx
+        obs[i + 1:i + 3 * n:3] = dy
+        obs[i + 2:i + 3 * n:3] = 1
+        return i + 3 * count
+
+OBS_SIZE = 8 + 3 * (OBS_ENEMIES + OBS_COINS) + 3 + 2 * OBS_FIREBALLS
+
+def vec_env_layout(num_envs, pixels=None):
+    # (name, dtype, shape) of the arrays VecMarioEnv shares with its workers
+    layout = [("obs", np.float32, (num_envs, OBS_SIZE)),
+              ("reward", np.float32, (num_envs,)),
+              ("terminated", np.bool_, (num_envs,)),
+              ("truncated", np.bool_, (num_envs,)),
+              ("action", np.uint8, (num_envs,))]
+    if pixels:
+        width, height = pixels
+        layout.append(("pixels", np.uint8,
+                       (num_envs, len(Rasterizer.channels), height, width)))
+    return layout
+
+def vec_env_arrays(buffer, num_envs, pixels=None):
+    arrays, offset = {}, 0
+    for name, dtype, shape in vec_env_layout(num_envs, pixels):
+        array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        arrays[name] = array
+        offset += array.nbytes
+    return arrays
+
+def vec_env_size(num_envs, pixels=None):
+    return sum(np.dtype(dtype).itemsize * int(np.prod(shape))
+               for _, dtype, shape in vec_env_layout(num_envs, pixels))
+
+def vec_env_run(envs, first, arrays, command, rasterizer=None):
+    # Carries out one VecMarioEnv command for envs[0] = env number first
+    obs, action = arrays["obs"], arrays["action"]
+    if command == b"r":
+        for i, env in enumerate(envs, first):
+            env.reset_into(obs[i])
+    else:
+        reward, terminated, truncated = arrays["reward"], arrays["terminated"], arrays["truncated"]
+        for i, env in enumerate(envs, first):
+            reward[i], terminated[i], truncated[i] = env.step_into(action[i], obs[i])
+            if terminated[i] or truncated[i]:
+                env.reset_into(obs[i])
+    if rasterizer:
+        rasterizer.render([env.sim for env in envs], arrays["pixels"][first:first + len(envs)])
+
+def vec_env_make(first, last, world_num, level_num, seed, max_ticks, frame_skip):
+    # Environments first..last-1 of a VecMarioEnv, each seeded seed + number
+    return [MarioEnv(world_num, level_num, None if seed is None else seed + i,
+                     max_ticks, frame_skip) for i in range(first, last)]
+
+def vec_env_worker(conn, name, num_envs, first, last, env_args, pixels):
+    # Worker process: steps envs first..last-1 in the shared arrays on command
+    memory = shared_memory.SharedMemory(name=name)
+    arrays = vec_env_arrays(memory.buf, num_envs, pixels)
+    envs = vec_env_make(first, last, *env_args)
+    rasterizer = Rasterizer(*pixels) if pixels else None
+    conn.send_bytes(b"ready")
+    while True:
+        command = conn.recv_bytes()
+        if command == b"c":
+            break
+        vec_env_run(envs, first, arrays, command, rasterizer)
+        conn.send_bytes(b"")
+    del arrays
+    memory.close()
+
+class VecMarioEnv:
+    # num_envs MarioEnvs stepped together, split across worker processes.
+    # Actions, observations, rewards and done flags live in one shared-memory
+    # block the workers write in place, so a step sends each worker a
+    # one-byte command and nothing is pickled. Finished environments reset
+    # automatically; the arrays returned are overwritten by the next call.
+    # workers=0 steps every environment in this process. With pixels set to
+    # (width, height), observations are Rasterizer grids of each worker's
+    # environments instead of feature vectors.
+    def __init__(self, num_envs, world_num=1, level_num=1, seed=None, max_ticks=60 * FPS,
+                 frame_skip=1, workers=None, pixels=None):
+        self.num_envs = num_envs
+        if workers is None:
+            workers = min(num_envs, os.cpu_count() or 1)
+        self.memory = shared_memory.SharedMemory(create=True,
+                                                 size=vec_env_size(num_envs, pixels))
+        self.arrays = vec_env_arrays(self.memory.buf, num_envs, pixels)
+        self.obs = self.arrays["pixels" if pixels else "obs"]
+        env_args = (world_num, level_num, seed, max_ticks, frame_skip)
+        self.envs = []
+        self.rasterizer = None
+        self.conns = []
+        self.processes = []
+        if not workers:
+            self.envs = vec_env_make(0, num_envs, *env_args)
+            self.rasterizer = Rasterizer(*pixels) if pixels else None
+        for w in range(workers):
+            first, last = num_envs * w // workers, num_envs * (w + 1) // workers
+            conn, child = Pipe()
+            process = Process(target=vec_env_worker, daemon=True,
+                              args=(child, self.memory.name, num_envs, first, last, env_args,
+                                    pixels))
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+        for conn in self.conns:
+            conn.recv_bytes()
+
+    def command(self, command):
+        if self.envs:
+            vec_env_run(self.envs, 0, self.arrays, command, self.rasterizer)
+            return
+        for conn in self.conns:
+            conn.send_bytes(command)
+        for conn in self.conns:
+            conn.recv_bytes()
+
+    def reset(self):
+        self.command(b"r")
+        return self.obs
+
+    def step(self, actions):
+        # Returns (obs, reward, terminated, truncated)
+        self.arrays["action"][:] = actions
+        self.command(b"s")
+        arrays = self.arrays
+        return self.obs, arrays["reward"], arrays["terminated"], arrays["truncated"]
+
+    def close(self):
+        for conn in self.conns:
+            conn.send_bytes(b"c")
+        for process in self.processes:
+            process.join()
+        self.conns, self.processes = [], []
+        self.arrays = self.obs = None
+        self.memory.close()
+        self.memory.unlink()
+
+class FrameScheduler:
+    # Per-state frame budgets for Game.run. Screens that only change on input
+    # (None) block in pygame.event.wait instead of redrawing; low-motion
+    # screens run at a reduced rate; play runs at play_fps, where 0 means as
+    # fast as the machine allows. Input wakes a blocked screen at once.
+    budgets = {
+        GameState.BS_MENU: None,
+        GameState.GAME_OVER: None,
+        GameState.OVERWORLD: 30,
+        GameState.VICTORY: 20,
+    }
+
+    def __init__(self, clock, play_fps=FPS):
+        self.clock = clock
+        self.play_fps = play_fps
+
+    def wait(self, state, blocking=True):
+        # blocking=False when something besides input, like a replay, can
+        # change a static screen
+        fps = self.budgets.get(state, self.play_fps)
+        if fps is None and not blocking:
+            fps = FPS
+        if fps is not None:
+            self.clock.tick(fps)
+            return
+        event = pygame.event.wait(IDLE_TIMEOUT)
+        if event.type != pygame.NOEVENT:
+            pygame.event.post(event)  # Leave it for read_inputs
+        self.clock.tick()
+
+class Game:
+    def __init__(self, dirty_rects=False, render_fps=FPS, turbo=0, seed=None,
+                 recorder=None, replay=None, rewind_seconds=REWIND_SECONDS, level_dir=None,
+                 generate=None):
+        self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        pygame.display.set_caption("Ultra Mario 2D Bros - BS Satellaview Edition")
+        self.clock = pygame.time.Clock()
+        # Turbo: run this many ticks per drawn frame, as fast as they go
+        self.turbo = turbo
+        self.tick_rate = 0  # Achieved ticks per second, shown in turbo
+        self.scheduler = FrameScheduler(self.clock, 0 if turbo else render_fps)
+        self.sim = Simulation(seed=seed, level_dir=level_dir, generate=generate)
+        # A ReplayWriter to record every tick's input to, and an iterator of
+        # Inputs played instead of the keyboard until it runs out
+        self.recorder = recorder
+        self.replay = replay
+        # Holding Backspace steps back through the last rewind_seconds, one
+        # tick per tick. Off with a recording or replay, whose inputs alone
+        # must reproduce the run.
+        self.rewind = None
+        if rewind_seconds and recorder is None and replay is None:
+            self.rewind = RewindBuffer(rewind_seconds)
+        self.rewinding = False
+        self.hud = None
+        self.hud_key = None
         self.mario_sprite_animation = 0
-        
-    def draw_bs_menu(self):
+        self.alpha = 1.0  # Where the drawn frame falls between the last two ticks
+        # Dirty-rect mode: the background is cached per scene and only the
+        # regions sprites cover, this frame and last, are redrawn and presented
+        self.dirty_rects = dirty_rects
+        self.background = pygame.Surface(self.screen.get_size()).convert()
+        self.scene = None
+        self.sprite_rects = []
+
+    def draw_bs_menu(self, screen):
         # BS Satellaview style menu
-        self.screen.fill((32, 0, 64))  # Deep purple background
+        screen.fill((32, 0, 64))  # Deep purple background
         
         # Title with gradient effect
-        title = self.font.render("BS ULTRA MARIO 2D BROS", True, WHITE)
+        title = TEXT.render("BS ULTRA MARIO 2D BROS", FONT_SIZE, WHITE)
         title_rect = title.get_rect(center=(SCREEN_WIDTH//2, 100))
-        self.screen.blit(title, title_rect)
+        screen.blit(title, title_rect)
         
         # Satellaview logo area
-        pygame.draw.rect(self.screen, (64, 0, 128), (250, 150, 300, 80))
-        pygame.draw.rect(self.screen, WHITE, (250, 150, 300, 80), 3)
-        bs_text = self.small_font.render("BS-X Satellaview System", True, WHITE)
-        self.screen.blit(bs_text, (320, 180))
+        pygame.draw.rect(screen, (64, 0, 128), (250, 150, 300, 80))
+        pygame.draw.rect(screen, WHITE, (250, 150, 300, 80), 3)
+        bs_text = TEXT.render("BS-X Satellaview System", SMALL_FONT_SIZE, WHITE)
+        screen.blit(bs_text, (320, 180))
         
         # Menu options
         menu_items = ["Start Game", "Select World", "Options", "Exit"]
         for i, item in enumerate(menu_items):
-            color = COIN_YELLOW if i == self.bs_menu_selection else WHITE
-            text = self.font.render(item, True, color)
-            self.screen.blit(text, (300, 280 + i * 60))
-            if i == self.bs_menu_selection:
-                pygame.draw.polygon(self.screen, COIN_YELLOW, 
+            color = COIN_YELLOW if i == self.sim.bs_menu_selection else WHITE
+            text = TEXT.render(item, FONT_SIZE, color)
+            screen.blit(text, (300, 280 + i * 60))
+            if i == self.sim.bs_menu_selection:
+                pygame.draw.polygon(screen, COIN_YELLOW, 
                                    [(270, 295 + i * 60), (290, 285 + i * 60), (290, 305 + i * 60)])
         
         # Footer
-        footer = self.small_font.render("© 1995 St.GIGA / Nintendo", True, WHITE)
-        self.screen.blit(footer, (260, 550))
-        
-    def draw_hud(self):
-        # SMB3 style HUD at top
-        pygame.draw.rect(self.screen, BLACK, (0, 0, SCREEN_WIDTH, 40))
+        footer = TEXT.render("© 1995 St.GIGA / Nintendo", SMALL_FONT_SIZE, WHITE)
+        screen.blit(footer, (260, 550))
         
+    def draw_hud(self, screen):
+        # SMB3 style HUD at top, re-rendered only when what it shows changes.
+        # Returns the HUD rect when it changed, otherwise None.
+        mario = self.sim.mario
+        if self.sim.current_level:
+            label = (f"WORLD {self.sim.current_level.world_num}-{self.sim.current_level.level_num}",
+                     WHITE)
+        elif self.sim.current_boss:
+            label = (f"WORLD {self.sim.current_boss.world_num} BOSS", (255, 100, 100))
+        else:
+            label = None
+        tick_rate = round(self.tick_rate) if self.turbo else None
+        key = (mario.lives, mario.coins, label, mario.power_up, tick_rate)
+        changed = key != self.hud_key
+        if changed:
+            self.hud = self.render_hud(*key)
+            self.hud_key = key
+        rect = screen.blit(self.hud, (0, 0))
+        return rect if changed else None
+
+    def render_hud(self, lives, coins, label, power_up, tick_rate=None):
+        hud = pygame.Surface((SCREEN_WIDTH, 40)).convert()
+        hud.fill(BLACK)
+
         # Lives
-        lives_text = self.small_font.render(f"MARIO x{self.mario.lives}", True, WHITE)
-        self.screen.blit(lives_text, (20, 10))
-        
+        hud.blit(TEXT.render(f"MARIO x{lives}", SMALL_FONT_SIZE, WHITE), (20, 10))
+
         # Coins
-        coins_text = self.small_font.render(f"COINS: {self.mario.coins:03d}", True, COIN_YELLOW)
-        self.screen.blit(coins_text, (200, 10))
-        
+        hud.blit(TEXT.render(f"COINS: {coins:03d}", SMALL_FONT_SIZE, COIN_YELLOW), (200, 10))
+
         # World/Level
-        if self.current_level:
-            level_text = self.small_font.render(
-                f"WORLD {self.current_level.world_num}-{self.current_level.level_num}", 
-                True, WHITE)
-            self.screen.blit(level_text, (400, 10))
-        elif self.current_boss:
-            level_text = self.small_font.render(
-                f"WORLD {self.current_boss.world_num} BOSS", 
-                True, (255, 100, 100))
-            self.screen.blit(level_text, (400, 10))
-            
+        if label:
+            hud.blit(TEXT.render(label[0], SMALL_FONT_SIZE, label[1]), (400, 10))
+
         # Power-up status
-        power_text = ["SMALL", "SUPER", "FIRE"][self.mario.power_up]
-        power_color = [WHITE, (255, 100, 100), ORANGE][self.mario.power_up]
-        p_text = self.small_font.render(power_text, True, power_color)
-        self.screen.blit(p_text, (600, 10))
-        
-    def run(self):
-        running = True
-        
-        while running:
-            # Event handling
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = False
-                    
-                if event.type == pygame.KEYDOWN:
-                    if self.state == GameState.BS_MENU:
-                        if event.key == pygame.K_UP:
-                            self.bs_menu_selection = (self.bs_menu_selection - 1) % 4
-                        elif event.key == pygame.K_DOWN:
-                            self.bs_menu_selection = (self.bs_menu_selection + 1) % 4
-                        elif event.key == pygame.K_RETURN:
-                            if self.bs_menu_selection == 0:  # Start Game
-                                self.state = GameState.OVERWORLD
-                            elif self.bs_menu_selection == 3:  # Exit
-                                running = False
-                        # Press 'q' to directly load a level from the menu
-                        elif event.key == pygame.K_q:
-                            self.current_level = Level(1, 1)
-                            self.state = GameState.LEVEL
-                            self.mario = Mario(100, 400)
-                                
-                    elif self.state == GameState.OVERWORLD:
-                        if event.key == pygame.K_LEFT and self.overworld.current_world > 0:
-                            # Check if previous world is completed
-                            if self.overworld.completed_levels[self.overworld.current_world - 1][3]:
-                                self.overworld.current_world -= 1
-                        elif event.key == pygame.K_RIGHT and self.overworld.current_world < 4:
-                            # Check if current world boss is defeated
-                            if self.overworld.completed_levels[self.overworld.current_world][3]:
-                                self.overworld.current_world += 1
-                        elif event.key == pygame.K_1:  # Level 1
-                            self.current_level = Level(self.overworld.current_world + 1, 1)
-                            self.state = GameState.LEVEL
-                            self.mario = Mario(100, 400)
-                        elif event.key == pygame.K_2:  # Level 2
-                            if self.overworld.completed_levels[self.overworld.current_world][0]:
-                                self.current_level = Level(self.overworld.current_world + 1, 2)
-                                self.state = GameState.LEVEL
-                                self.mario = Mario(100, 400)
-                        elif event.key == pygame.K_3:  # Level 3
-                            if self.overworld.completed_levels[self.overworld.current_world][1]:
-                                self.current_level = Level(self.overworld.current_world + 1, 3)
-                                self.state = GameState.LEVEL
-                                self.mario = Mario(100, 400)
-                        elif event.key == pygame.K_b:  # Boss
-                            if self.overworld.completed_levels[self.overworld.current_world][2]:
-                                self.current_boss = BossLevel(self.overworld.current_world + 1)
-                                self.state = GameState.BOSS
-                                self.mario = Mario(100, 400)
-                        elif event.key == pygame.K_ESCAPE:
-                            self.state = GameState.BS_MENU
-                        # Press 'q' to directly load a level from overworld
-                        elif event.key == pygame.K_q:
-                            self.current_level = Level(self.overworld.current_world + 1, 1)
-                            self.state = GameState.LEVEL
-                            self.mario = Mario(100, 400)
-                            
-                    elif self.state in [GameState.LEVEL, GameState.BOSS]:
-                        if event.key == pygame.K_SPACE or event.key == pygame.K_UP:
-                            self.mario.jump()
-                        elif event.key == pygame.K_ESCAPE:
-                            self.state = GameState.OVERWORLD
-                        # Press 'q' to load a new level while in a level
-                        elif event.key == pygame.K_q:
-                            if self.current_level:
-                                next_level = (self.current_level.level_num % 3) + 1
-                                self.current_level = Level(self.current_level.world_num, next_level)
-                            else:
-                                self.current_level = Level(1, 1)
-                            self.mario = Mario(100, 400)
-                            
-                    elif self.state == GameState.GAME_OVER:
-                        if event.key == pygame.K_RETURN:
-                            self.__init__()
-                        # Press 'q' to load a level from game over screen
-                        elif event.key == pygame.K_q:
-                            self.current_level = Level(1, 1)
-                            self.state = GameState.LEVEL
-                            self.mario = Mario(100, 400)
-                            
-                    elif self.state == GameState.VICTORY:
-                        if event.key == pygame.K_RETURN:
-                            self.state = GameState.BS_MENU
-                        # Press 'q' to load a level from victory screen
-                        elif event.key == pygame.K_q:
-                            self.current_level = Level(1, 1)
-                            self.state = GameState.LEVEL
-                            self.mario = Mario(100, 400)
-                            
-            # Continuous key input for movement
-            if self.state in [GameState.LEVEL, GameState.BOSS]:
-                keys = pygame.key.get_pressed()
-                if keys[pygame.K_LEFT]:
-                    self.mario.move_left()
-                elif keys[pygame.K_RIGHT]:
-                    self.mario.move_right()
-                else:
-                    self.mario.stop()
-                    
-            # Update game logic
-            if self.state == GameState.LEVEL:
-                if self.current_level:
-                    if not self.mario.update(self.current_level.platforms):
-                        if self.mario.lives <= 0:
-                            self.state = GameState.GAME_OVER
-                        else:
-                            # Respawn
-                            self.mario = Mario(100, 400)
-                            
-                    self.current_level.update(self.mario)
-                    
-                    if self.current_level.completed:
-                        # Mark level as completed
-                        level_index = self.current_level.level_num - 1
-                        self.overworld.completed_levels[self.overworld.current_world][level_index] = True
-                        # Unlock next level
-                        if level_index < 2:
-                            self.overworld.completed_levels[self.overworld.current_world][level_index + 1] = True
-                        self.state = GameState.OVERWORLD
-                        
-            elif self.state == GameState.BOSS:
-                if self.current_boss:
-                    if not self.mario.update(self.current_boss.platforms):
-                        if self.mario.lives <= 0:
-                            self.state = GameState.GAME_OVER
-                        else:
-                            # Respawn
-                            self.mario = Mario(100, 400)
-                            
-                    self.current_boss.update(self.mario)
-                    
-                    if self.current_boss.completed:
-                        # Mark boss as defeated
-                        self.overworld.completed_levels[self.overworld.current_world][3] = True
-                        # Check if all worlds completed
-                        if self.overworld.current_world == 4:
-                            self.state = GameState.VICTORY
-                        else:
-                            # Unlock next world
-                            if self.overworld.current_world < 4:
-                                self.overworld.current_world += 1
-                            self.state = GameState.OVERWORLD
-                            
-            # Animation
-            self.mario_sprite_animation = (self.mario_sprite_animation + 1) % 40
+        power_text = ["SMALL", "SUPER", "FIRE"][power_up]
+        power_color = [WHITE, (255, 100, 100), ORANGE][power_up]
+        hud.blit(TEXT.render(power_text, SMALL_FONT_SIZE, power_color), (600, 10))
+
+        # Turbo speed
+        if tick_rate is not None:
+            hud.blit(TEXT.render(f"{tick_rate} t/s", SMALL_FONT_SIZE, PURPLE), (690, 10))
+        return hud
+
+    def draw(self):
+        # Full frame
+        self.draw_background(self.screen)
+        self.draw_sprites(self.screen)
+
+    def draw_background(self, screen):
+        # Everything that stays put until scene_key() changes
+        if self.sim.state == GameState.BS_MENU:
+            self.draw_bs_menu(screen)
             
-            # Drawing
-            if self.state == GameState.BS_MENU:
-                self.draw_bs_menu()
-                
-            elif self.state == GameState.OVERWORLD:
-                # Draw overworld with animated Mario
-                self.screen.fill(SKY_BLUE)
-                
-                # Animated clouds
-                for i in range(3):
-                    x = (i * 250 + self.mario_sprite_animation * 2) % (SCREEN_WIDTH + 100) - 50
-                    y = 50 + i * 30
-                    pygame.draw.ellipse(self.screen, WHITE, (x, y, 80, 40))
-                    pygame.draw.ellipse(self.screen, WHITE, (x + 20, y - 10, 60, 40))
-                    pygame.draw.ellipse(self.screen, WHITE, (x + 40, y, 60, 40))
-                    
-                # Hills background
-                pygame.draw.ellipse(self.screen, (34, 139, 34), (50, 400, 200, 300))
-                pygame.draw.ellipse(self.screen, (34, 139, 34), (500, 420, 250, 280))
-                
-                mario_y = math.sin(self.mario_sprite_animation * 0.15) * 5
-                self.overworld.draw(self.screen, 0, mario_y)
-                
-                # Instructions
-                inst = self.small_font.render("Press 1-3 for levels, B for Boss, Arrow keys to select world, Q for quick level", True, WHITE)
-                self.screen.blit(inst, (50, 550))
-                
-            elif self.state == GameState.LEVEL:
-                # Draw level
-                self.screen.fill(SKY_BLUE)
-                self.current_level.draw(self.screen)
-                self.mario.draw(self.screen)
-                self.draw_hud()
-                
-            elif self.state == GameState.BOSS:
-                # Draw boss arena
-                self.screen.fill((64, 0, 0))  # Dark red sky for boss
-                self.current_boss.draw(self.screen)
-                self.mario.draw(self.screen)
-                self.draw_hud()
-                
-            elif self.state == GameState.GAME_OVER:
-                self.screen.fill(BLACK)
-                game_over_text = self.font.render("GAME OVER", True, (255, 0, 0))
-                game_over_rect = game_over_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 - 50))
-                self.screen.blit(game_over_text, game_over_rect)
-                
-                continue_text = self.small_font.render("Press ENTER to restart or Q to play level", True, WHITE)
-                continue_rect = continue_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 50))
-                self.screen.blit(continue_text, continue_rect)
-                
-            elif self.state == GameState.VICTORY:
-                self.screen.fill(SKY_BLUE)
-                
-                # Victory animation
-                for i in range(10):
-                    x = random.randint(0, SCREEN_WIDTH)
-                    y = random.randint(0, SCREEN_HEIGHT)
-                    color = random.choice([COIN_YELLOW, ORANGE, (255, 0, 255), (0, 255, 255)])
-                    pygame.draw.circle(self.screen, color, (x, y), random.randint(2, 8))
-                    
-                victory_text = self.font.render("CONGRATULATIONS!", True, COIN_YELLOW)
-                victory_rect = victory_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 - 100))
-                self.screen.blit(victory_text, victory_rect)
-                
-                complete_text = self.font.render("YOU SAVED THE MUSHROOM KINGDOM!", True, WHITE)
-                complete_rect = complete_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
-                self.screen.blit(complete_text, complete_rect)
-                
-                thanks_text = self.small_font.render("Thank you for playing Ultra Mario 2D Bros!", True, WHITE)
-                thanks_rect = thanks_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 80))
-                self.screen.blit(thanks_text, thanks_rect)
-                
-                continue_text = self.small_font.render("Press ENTER to return to menu or Q to play level", True, WHITE)
-                continue_rect = continue_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 150))
-                self.screen.blit(continue_text, continue_rect)
+        elif self.sim.state == GameState.OVERWORLD:
+            # Draw overworld (clouds and Mario are sprites)
+            screen.fill(SKY_BLUE)
+            
+            # Hills background
+            pygame.draw.ellipse(screen, (34, 139, 34), (50, 400, 200, 300))
+            pygame.draw.ellipse(screen, (34, 139, 34), (500, 420, 250, 280))
+            
+            self.sim.overworld.draw_map(screen)
+            
+            # Instructions
+            inst = TEXT.render("Press 1-3 for levels, B for Boss, Arrow keys to select world, Q for quick level", SMALL_FONT_SIZE, WHITE)
+            screen.blit(inst, (50, 550))
+            
+        elif self.sim.state == GameState.LEVEL:
+            # Draw level
+            level = self.sim.current_level
+            screen.fill(level.sky)
+            level.static_layer.draw(screen, level.draw_static, self.camera_x())
+            
+        elif self.sim.state == GameState.BOSS:
+            # Draw boss arena
+            boss = self.sim.current_boss
+            screen.fill(boss.sky)
+            boss.static_layer.draw(screen, boss.draw_static)
+            
+        elif self.sim.state == GameState.GAME_OVER:
+            screen.fill(BLACK)
+            game_over_text = TEXT.render("GAME OVER", FONT_SIZE, (255, 0, 0))
+            game_over_rect = game_over_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 - 50))
+            screen.blit(game_over_text, game_over_rect)
+            
+            continue_text = TEXT.render("Press ENTER to restart or Q to play level", SMALL_FONT_SIZE, WHITE)
+            continue_rect = continue_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 50))
+            screen.blit(continue_text, continue_rect)
+            
+        elif self.sim.state == GameState.VICTORY:
+            screen.fill(SKY_BLUE)
+            
+            # Victory animation, the same for the same tick
+            rng = random.Random(self.sim.ticks)
+            for i in range(10):
+                x = rng.randint(0, SCREEN_WIDTH)
+                y = rng.randint(0, SCREEN_HEIGHT)
+                color = rng.choice([COIN_YELLOW, ORANGE, (255, 0, 255), (0, 255, 255)])
+                pygame.draw.circle(screen, color, (x, y), rng.randint(2, 8))
                 
-            pygame.display.flip()
-            self.clock.tick(FPS)
+            victory_text = TEXT.render("CONGRATULATIONS!", FONT_SIZE, COIN_YELLOW)
+            victory_rect = victory_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 - 100))
+            screen.blit(victory_text, victory_rect)
+            
+            complete_text = TEXT.render("YOU SAVED THE MUSHROOM KINGDOM!", FONT_SIZE, WHITE)
+            complete_rect = complete_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2))
+            screen.blit(complete_text, complete_rect)
+            
+            thanks_text = TEXT.render("Thank you for playing Ultra Mario 2D Bros!", SMALL_FONT_SIZE, WHITE)
+            thanks_rect = thanks_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 80))
+            screen.blit(thanks_text, thanks_rect)
             
+            continue_text = TEXT.render("Press ENTER to return to menu or Q to play level", SMALL_FONT_SIZE, WHITE)
+            continue_rect = continue_text.get_rect(center=(SCREEN_WIDTH//2, SCREEN_HEIGHT//2 + 150))
+            screen.blit(continue_text, continue_rect)
+
+    def draw_sprites(self, screen):
+        # Everything that moves over the background; returns the rects drawn
+        rects = []
+        if self.sim.state == GameState.OVERWORLD:
+            # Animated clouds
+            for i in range(3):
+                x = (i * 250 + self.mario_sprite_animation * 2) % (SCREEN_WIDTH + 100) - 50
+                y = 50 + i * 30
+                rects.append(pygame.draw.ellipse(screen, WHITE, (x, y, 80, 40)))
+                rects.append(pygame.draw.ellipse(screen, WHITE, (x + 20, y - 10, 60, 40)))
+                rects.append(pygame.draw.ellipse(screen, WHITE, (x + 40, y, 60, 40)))
+
+            # Mini Mario bobbing on the current world
+            mario_y = math.sin(self.mario_sprite_animation * 0.15) * 5
+            rects.append(self.sim.overworld.draw_marker(screen, 0, mario_y))
+
+        elif self.sim.state in [GameState.LEVEL, GameState.BOSS]:
+            level = self.sim.current_level if self.sim.state == GameState.LEVEL else self.sim.current_boss
+            camera_x = self.camera_x()
+            rects += level.draw_sprites(screen, camera_x, self.alpha)
+            rects.append(self.sim.mario.draw(screen, self.alpha, camera_x))
+            hud = self.draw_hud(screen)
+            if hud:
+                rects.append(hud)
+        return rects
+
+    def camera_x(self):
+        # Left edge of the view, following Mario where he is drawn
+        sim = self.sim
+        if sim.state == GameState.LEVEL:
+            return follow_camera(sim.current_level.width, sim.mario.position(self.alpha)[0])
+        return 0
+
+    def scene_key(self):
+        # Changes whenever the cached background has to be repainted
+        sim = self.sim
+        if sim.state == GameState.BS_MENU:
+            return (sim.state, sim.bs_menu_selection)
+        if sim.state == GameState.OVERWORLD:
+            return (sim.state, sim.overworld.current_world,
+                    tuple(map(tuple, sim.overworld.completed_levels)))
+        if sim.state == GameState.LEVEL:
+            return (sim.state, sim.current_level, sim.current_level.static_layer.version,
+                    self.camera_x())
+        if sim.state == GameState.BOSS:
+            return (sim.state, sim.current_boss, sim.current_boss.static_layer.version)
+        if sim.state == GameState.VICTORY:
+            return (sim.state, sim.ticks)  # Confetti changes every frame
+        return (sim.state,)
+
+    def present(self):
+        if not self.dirty_rects:
+            self.draw()
+            pygame.display.flip()
+            return
+
+        key = self.scene_key()
+        if key != self.scene:
+            self.scene = key
+            self.draw_background(self.background)
+            self.screen.blit(self.background, (0, 0))
+            self.hud_key = None
+            self.sprite_rects = self.draw_sprites(self.screen)
+            pygame.display.flip()
+            return
+
+        # Erase last frame's sprites, draw this frame's, present both areas
+        for rect in self.sprite_rects:
+            self.screen.blit(self.background, rect, rect)
+        rects = self.draw_sprites(self.screen)
+        pygame.display.update(self.sprite_rects + rects)
+        self.sprite_rects = rects
+
+    def snapshot(self):
+        # Everything drawn is derived from the simulation, so its state is
+        # the whole save state
+        return self.sim.snapshot()
+
+    def restore(self, state):
+        self.sim.restore(state)
+
+    def read_inputs(self):
+        # Translate pygame events and key state into one tick of Inputs
+        pressed = []
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.sim.running = False
+            if event.type == pygame.KEYDOWN:
+                pressed.append(event.key)
+        keys = pygame.key.get_pressed()
+        self.rewinding = keys[pygame.K_BACKSPACE]
+        return Inputs(pressed, keys[pygame.K_LEFT], keys[pygame.K_RIGHT])
+
+    def run(self):
+        # Fixed-step loop: real time elapsed buys simulation ticks of 1/FPS s,
+        # and each frame is drawn interpolated between the last two ticks. A
+        # slow frame runs several ticks (frame skipping); past
+        # MAX_TICKS_PER_FRAME the game slows down instead of falling behind.
+        # In turbo every frame runs self.turbo ticks, however long they take.
+        tick = 1.0 / FPS
+        accumulator = tick
+        last = rate_start = time.perf_counter()
+        rate_ticks = 0
+        pressed = []
+        while self.sim.running:
+            now = time.perf_counter()
+            accumulator = min(accumulator + now - last, tick * MAX_TICKS_PER_FRAME)
+            last = now
+            if self.turbo:
+                ticks = self.turbo
+                accumulator = 0.0
+            else:
+                ticks = int(accumulator / tick)
+                accumulator -= ticks * tick
+
+            # Key presses are held over until a tick is due to take them
+            inputs = self.read_inputs()
+            pressed += inputs.pressed
+            for _ in range(ticks):
+                if not self.sim.running:
+                    break
+                tick_inputs = Inputs(pressed, inputs.left, inputs.right)
+                pressed = []
+                if self.rewind is not None:
+                    if self.rewinding:
+                        snapshot = self.rewind.pop()
+                        if snapshot is not None:
+                            self.sim.restore(snapshot)
+                        continue
+                    self.rewind.push(self.sim.snapshot())
+                if self.replay:
+                    tick_inputs = next(self.replay, None)
+                    if tick_inputs is None:
+                        self.replay = None  # Over to the player
+                        continue
+                if self.recorder:
+                    self.recorder.record(tick_inputs)
+                self.sim.step(tick_inputs)
+
+                # Animation
+                self.mario_sprite_animation = (self.mario_sprite_animation + 1) % 40
+
+            rate_ticks += ticks
+            if now - rate_start >= 1.0:
+                self.tick_rate = rate_ticks / (now - rate_start)
+                rate_start, rate_ticks = now, 0
+
+            self.alpha = 1.0 if self.turbo else accumulator / tick
+            self.present()
+            self.scheduler.wait(self.sim.state, self.replay is None)
+
+        if self.recorder:
+            self.recorder.close()
+
         pygame.quit()
         sys.exit()
 
 if __name__ == "__main__":
-    game = Game()
+    parser = argparse.ArgumentParser(description="Ultra Mario 2D Bros")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="redraw and present only the screen regions that change")
+    parser.add_argument("--render-fps", type=int, default=FPS,
+                        help="frame rate cap during play, 0 for none (the simulation "
+                             "always runs at %d ticks per second)" % FPS)
+    parser.add_argument("--turbo", type=int, default=0, metavar="TICKS",
+                        help="fast-forward: run TICKS simulation ticks per drawn frame, "
+                             "uncapped, showing ticks/sec in the HUD")
+    parser.add_argument("--seed", type=int,
+                        help="seed the simulation's random numbers for a reproducible run")
+    parser.add_argument("--fixed-point", action="store_true",
+                        help="fixed-point physics, bit-identical on every platform")
+    parser.add_argument("--record", metavar="FILE", help="record every tick's input to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="play back a recording")
+    parser.add_argument("--headless", action="store_true",
+                        help="with --replay, run it at full speed without a window")
+    parser.add_argument("--rewind", type=int, default=REWIND_SECONDS, metavar="SECONDS",
+                        help="seconds of play Backspace can rewind, 0 for none")
+    parser.add_argument("--levels", metavar="DIR",
+                        help="load stages from the level files in DIR (see export_levels.py); "
+                             "replays recorded with it need the same DIR")
+    parser.add_argument("--generate", type=int, metavar="SEED",
+                        help="play levels generated from SEED (cached in %s); "
+                             "replays recorded with it generate them again" % LEVEL_CACHE_DIR)
+    parser.add_argument("--screens", type=int, default=20,
+                        help="length of generated levels in screens")
+    args = parser.parse_args()
+    generate = None if args.generate is None else (args.generate, args.screens)
+    if args.fixed_point:
+        use_fixed_point()
+
+    if args.replay and args.headless:
+        start = time.perf_counter()
+        try:
+            sim = play_replay(args.replay, args.levels, generate)
+        except ValueError as error:
+            parser.error(str(error))
+        elapsed = time.perf_counter() - start
+        print(f"{sim.ticks} ticks in {elapsed:.2f}s ({sim.ticks / elapsed:.0f} ticks/s): "
+              f"{sim.state.name}, lives {sim.mario.lives}, coins {sim.mario.coins}")
+        sys.exit()
+
+    seed, recorder, replay = args.seed, None, None
+    if args.replay:
+        reader = ReplayReader(args.replay)
+        try:
+            generate = reader.levels(args.levels, generate)
+        except ValueError as error:
+            parser.error(str(error))
+        use_fixed_point(reader.fixed_point)
+        seed, replay = reader.seed, iter(reader)
+    if args.record:
+        if seed is None:
+            seed = random.randrange(2 ** 63)  # Recordings always need a seed
+        recorder = ReplayWriter(args.record, seed, FIXED_POINT, level_dir=args.levels,
+                                generate=generate)
+    game = Game(dirty_rects=args.dirty_rects, render_fps=args.render_fps, turbo=args.turbo,
+                seed=seed, recorder=recorder, replay=replay, rewind_seconds=args.rewind,
+                level_dir=args.levels, generate=generate)
     game.run()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Ultra Mario 2D Bros - level exporter
+Writes the built-in worlds as binary level files for --levels:
+python export_levels.py levels
+"""
+
+import argparse
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+from claudemario4k import BossLevel, Level, level_file_name, write_level_file
+
+def export(directory):
+    os.makedirs(directory, exist_ok=True)
+    for world in range(1, 6):
+        for number in (1, 2, 3):
+            level = Level(world, number)
+            enemies = [(e.x, e.y, e.type) for e in level.enemies]
+            coins = [(c.x, c.y) for c in level.coins]
+            path = os.path.join(directory, level_file_name(world, number))
+            write_level_file(path, world, number, level.width, level.platforms, enemies, coins,
+                             (level.goal_x, level.goal_y), level.sky)
+            yield path
+        arena = BossLevel(world)
+        path = os.path.join(directory, level_file_name(world, None))
+        write_level_file(path, world, 0, arena.width, arena.platforms, [], [],
+                         (arena.boss.x, arena.boss.y), arena.sky)
+        yield path
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", help="where to write the level files")
+    args = parser.parse_args()
+    for path in export(args.directory):
+        print(f"{path}: {os.path.getsize(path)} bytes")
+
+if __name__ == "__main__":
+    sys.exit(main())
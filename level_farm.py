@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Ultra Mario 2D Bros - level evaluation farm
+Monte Carlo difficulty estimates from headless rollouts run in parallel:
+python level_farm.py all --rollouts 200 --policy random
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from multiprocessing import Pool
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+from claudemario4k import ACTIONS, FPS, GameState, Inputs, Simulation
+
+DEATH_BIN = 100  # Death positions are reported in bins this many pixels wide
+
+def random_policy(rng):
+    # Random actions, each held for a random stretch
+    while True:
+        left, right, jump = rng.choice(ACTIONS)
+        inputs = Inputs([pygame.K_SPACE] if jump else [], left, right)
+        for _ in range(rng.randint(5, 30)):
+            yield inputs
+
+def runner_policy(rng):
+    # Hold right and jump at a jittered rhythm, like a hurried player
+    while True:
+        period = rng.randint(20, 40)
+        for tick in range(period):
+            yield Inputs([pygame.K_SPACE] if tick == 0 else [], False, True)
+
+POLICIES = {
+    "random": random_policy,
+    "runner": runner_policy,
+}
+
+def parse_spec(spec):
+    # "all", or comma-separated "W-L" items where L is 1-3, "B" for the boss
+    # or "*" for all four: "1-1,2-*,5-B"
+    if spec == "all":
+        spec = ",".join(f"{world}-*" for world in range(1, 6))
+    stages = []
+    for item in spec.split(","):
+        world, _, level = item.strip().partition("-")
+        world = int(world)
+        if not 1 <= world <= 5:
+            raise ValueError(f"no world {world} in {item!r}")
+        if level == "*":
+            stages += [(world, 1), (world, 2), (world, 3), (world, None)]
+        elif level.upper() == "B":
+            stages.append((world, None))
+        elif level in ("1", "2", "3"):
+            stages.append((world, int(level)))
+        else:
+            raise ValueError(f"bad level in {item!r}")
+    return stages
+
+def stage_name(world, level):
+    return f"{world}-{'B' if level is None else level}"
+
+def rollout(sim, start, seed, policy, max_ticks):
+    # One rollout from the start snapshot: (completed, ticks, deaths, coins)
+    sim.restore(start)
+    sim.rng.seed(seed)
+    deaths = []
+    inputs = POLICIES[policy](random.Random(seed))
+    for tick in range(max_ticks):
+        # Where Mario was the tick before he fell, as he respawns in place
+        x, y, lost = sim.mario.x, sim.mario.y, sim.deaths
+        sim.step(next(inputs))
+        if sim.deaths != lost:
+            deaths.append((round(x), round(y)))
+        if sim.state not in (GameState.LEVEL, GameState.BOSS):
+            break
+    completed = sim.state in (GameState.OVERWORLD, GameState.VICTORY)
+    coins = 0
+    if sim.current_level:
+        level = sim.current_level
+        coins = int(level.coins.collected[:level.coins.count].sum())
+    return completed, tick + 1, deaths, coins
+
+def run_chunk(task):
+    # Worker: a run of rollouts on one stage, sharing one generated level
+    world, level, policy, seeds, max_ticks = task
+    sim = Simulation(seed=seeds[0])
+    if level is None:
+        sim.start_boss(world)
+    else:
+        sim.start_level(world, level)
+    start = sim.snapshot()
+    return (world, level), [rollout(sim, start, seed, policy, max_ticks) for seed in seeds]
+
+def summarize(results):
+    completed = [ticks for done, ticks, _, _ in results if done]
+    deaths = [death for _, _, run_deaths, _ in results for death in run_deaths]
+    bins = {}
+    for x, _ in deaths:
+        start = x // DEATH_BIN * DEATH_BIN
+        bins[start] = bins.get(start, 0) + 1
+    return {
+        "rollouts": len(results),
+        "completion_rate": len(completed) / len(results),
+        "median_seconds_to_complete": statistics.median(completed) / FPS if completed else None,
+        "deaths_per_rollout": len(deaths) / len(results),
+        "death_bins": {f"{x}-{x + DEATH_BIN}": n for x, n in sorted(bins.items())},
+        "mean_coins": sum(coins for _, _, _, coins in results) / len(results),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("spec", nargs="?", default="all",
+                        help='stages to evaluate: "all" or e.g. "1-1,2-*,5-B"')
+    parser.add_argument("--rollouts", type=int, default=100, help="rollouts per stage")
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="random")
+    parser.add_argument("--seconds", type=float, default=30,
+                        help="give up on a rollout after this much game time")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--seed", type=int, default=0, help="first rollout seed")
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    args = parser.parse_args()
+
+    stages = parse_spec(args.spec)
+    max_ticks = int(args.seconds * FPS)
+    # Chunks small enough to balance across workers, big enough that
+    # generating the level is a small part of each
+    chunk = max(1, min(50, args.rollouts * len(stages) // (args.workers * 4)))
+    tasks = []
+    for world, level in stages:
+        seeds = range(args.seed, args.seed + args.rollouts)
+        for i in range(0, args.rollouts, chunk):
+            tasks.append((world, level, args.policy, seeds[i:i + chunk], max_ticks))
+
+    start = time.perf_counter()
+    results = {stage: [] for stage in stages}
+    with Pool(args.workers) as pool:
+        for stage, chunk_results in pool.imap_unordered(run_chunk, tasks):
+            results[stage] += chunk_results
+        # SDL turns SIGTERM into a quit event, so let workers exit on their
+        # own rather than have the pool terminate them
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+
+    report = {stage_name(*stage): summarize(runs) for stage, runs in results.items()}
+    print("stage   rollouts   complete   median s   deaths/run   deadliest x   coins")
+    for name, row in report.items():
+        median = row["median_seconds_to_complete"]
+        bins = row["death_bins"]
+        deadliest = max(bins, key=bins.get) if bins else "-"
+        print(f"{name:5s}   {row['rollouts']:8d}   {row['completion_rate']:7.1%}   "
+              f"{'-' if median is None else f'{median:.1f}':>8s}   "
+              f"{row['deaths_per_rollout']:10.2f}   {deadliest:>11s}   {row['mean_coins']:5.2f}")
+    total = args.rollouts * len(stages)
+    print(f"{total} rollouts in {elapsed:.1f}s with {args.workers} workers "
+          f"({total / elapsed:.0f} rollouts/s)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"policy": args.policy, "seconds": args.seconds, "stages": report}, f,
+                      indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())